@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import socket
+import statistics
+import struct
+import tempfile
+import time
+
+# --- Tunnel Benchmark ---
+# Runs the real SOCKS5 client (client.start_client) and the real server loop
+# (server.handle_drive_requests) in one process against a local stand-in for
+# Google Drive (see storage_backends.py) with simulated API latency and call quota,
+# and fetches payloads from a local HTTP origin through the tunnel.
+#
+# For every payload size and connection count it reports:
+#   TTFB        - time from sending the HTTP request to the first response byte (median)
+#   throughput  - payload bytes of all connections per second of wall time
+#   calls/MB    - storage API calls (all operations, both sides) per transferred MB
+#   p50 / p99   - latency of a packet file from the start of its upload to the end
+#                 of its download on the other side
+#
+# Example:
+#   python benchmark_tunnel.py --sizes 1024,1048576 --connections 1,8 --latency 0.2 --rate 10
+# No Google account or network access is needed.
+
+# A throwaway key, so drive_utils_requests can be imported without a configured key
+os.environ.setdefault('DRIVEVPN_ENCRYPTION_KEY', 'YmVuY2htYXJrLWtleS1ub3QtZm9yLXJlYWwtdXNlMDA=')
+
+import client
+import server
+import metrics
+from storage_backends import StorageBackend, create_storage_backend
+from compression import compression_stats
+
+ORIGIN_HOST = '127.0.0.1'
+ORIGIN_PORT = 18080
+SOCKS_PORT = 11080
+BODY_PATTERN = bytes(range(251)) # Prime-length pattern, so misplaced bytes are detected
+RANDOM_PATTERN = os.urandom(1000003) # Incompressible alternative (prime length, larger than any compression window)
+
+
+class InstrumentedStorage(StorageBackend):
+    """
+    Wraps a storage backend and records, for every packet file, the time from the
+    start of its upload to the end of its first download.
+    """
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.call_counts = backend.call_counts # Shared, so totals include both sides
+        self.packet_latencies = []
+        self._upload_started = {} # key: file id, value: time.monotonic() at upload start
+
+    async def list_files(self, folder_id, max_files=None):
+        return await self.backend.list_files(folder_id, max_files=max_files)
+
+    async def list_new_files(self, folder_id):
+        return await self.backend.list_new_files(folder_id)
+
+    async def upload(self, file_name, content_bytes, folder_id):
+        started = time.monotonic()
+        file_id = await self.backend.upload(file_name, content_bytes, folder_id)
+        if file_id:
+            self._upload_started[file_id] = started
+        return file_id
+
+    async def download(self, file_id):
+        content = await self.backend.download(file_id)
+        started = self._upload_started.pop(file_id, None)
+        if content and started is not None:
+            self.packet_latencies.append(time.monotonic() - started)
+        return content
+
+    async def delete(self, file_id):
+        return await self.backend.delete(file_id)
+
+    async def delete_batch(self, file_ids):
+        return await self.backend.delete_batch(file_ids)
+
+
+async def handle_origin(reader, writer):
+    """
+    Minimal HTTP origin: GET /<n> answers with n bytes of BODY_PATTERN.
+    """
+    try:
+        request = await reader.readuntil(b'\r\n\r\n')
+        size = int(request.split(b' ', 2)[1].lstrip(b'/') or 0)
+        body = (BODY_PATTERN * (size // len(BODY_PATTERN) + 1))[:size]
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % size)
+        writer.write(body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def fetch_through_tunnel(size):
+    """
+    Fetches a payload of `size` bytes from the origin through the SOCKS5 client.
+    Returns (ttfb, duration, body_bytes).
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', SOCKS_PORT)
+    try:
+        writer.write(b'\x05\x01\x00')
+        await reader.readexactly(2)
+        writer.write(b'\x05\x01\x00\x01' + socket.inet_aton(ORIGIN_HOST) + struct.pack('!H', ORIGIN_PORT))
+        await reader.readexactly(10)
+
+        started = time.monotonic()
+        writer.write(b'GET /%d HTTP/1.1\r\nHost: benchmark\r\n\r\n' % size)
+        await writer.drain()
+        first = await reader.read(1)
+        if not first:
+            raise ConnectionError("Tunnel closed before the response")
+        ttfb = time.monotonic() - started
+        head = first + await reader.readuntil(b'\r\n\r\n')
+        length = int(head.split(b'Content-Length: ')[1].split(b'\r\n')[0])
+        body = await reader.readexactly(length)
+        duration = time.monotonic() - started
+    finally:
+        writer.close()
+
+    if body != (BODY_PATTERN * (length // len(BODY_PATTERN) + 1))[:length]:
+        raise ValueError(f"Corrupted payload ({length} bytes)")
+    return ttfb, duration, length
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_scenario(storage, size, connections, timeout):
+    """
+    Runs `connections` concurrent fetches of `size` bytes and returns the measurements.
+    """
+    calls_before = sum(storage.call_counts.values())
+    storage.packet_latencies.clear()
+    started = time.monotonic()
+    results = await asyncio.wait_for(
+        asyncio.gather(*(fetch_through_tunnel(size) for _ in range(connections))), timeout)
+    wall = time.monotonic() - started
+    transferred = sum(length for _, _, length in results)
+    calls = sum(storage.call_counts.values()) - calls_before
+    return {
+        'size': size,
+        'connections': connections,
+        'ttfb_s': statistics.median(ttfb for ttfb, _, _ in results),
+        'wall_s': wall,
+        'throughput_mbps': transferred / wall / 1e6,
+        'api_calls': calls,
+        'calls_per_mb': calls / max(transferred / 1e6, 1e-6),
+        'packet_p50_s': percentile(storage.packet_latencies, 0.50),
+        'packet_p99_s': percentile(storage.packet_latencies, 0.99),
+        'packets': len(storage.packet_latencies),
+    }
+
+
+async def run_benchmark(args):
+    if args.backend == 'local':
+        tmp_dir = tempfile.TemporaryDirectory(prefix='drivevpn-bench-')
+        backend = create_storage_backend('local', root_dir=tmp_dir.name, latency=args.latency,
+                                         jitter=args.jitter, calls_per_second=args.rate, burst=args.burst)
+    else:
+        tmp_dir = None
+        backend = create_storage_backend('memory', latency=args.latency, jitter=args.jitter,
+                                         calls_per_second=args.rate, burst=args.burst)
+    storage = InstrumentedStorage(backend)
+    for module in (client, server):
+        module.storage = storage
+        module.packet_collector.storage = storage
+        module.METRICS_PORT = None # No endpoint; stage timings can be dumped with --metrics
+
+    origin = await asyncio.start_server(handle_origin, ORIGIN_HOST, ORIGIN_PORT)
+    tasks = [asyncio.create_task(server.handle_drive_requests()),
+             asyncio.create_task(client.start_client('127.0.0.1', SOCKS_PORT))]
+    await asyncio.sleep(0.5) # Let the SOCKS5 listener come up
+
+    results = []
+    try:
+        for size in args.sizes:
+            for connections in args.connections:
+                for _ in range(args.repeat):
+                    result = await run_scenario(storage, size, connections, args.timeout)
+                    results.append(result)
+                    print(f"{size:>10} B x {connections:>3} conn | TTFB {result['ttfb_s']*1000:8.1f} ms | "
+                          f"{result['throughput_mbps']:8.3f} MB/s | {result['calls_per_mb']:9.1f} calls/MB | "
+                          f"packet p50 {result['packet_p50_s']*1000:8.1f} ms p99 {result['packet_p99_s']*1000:8.1f} ms",
+                          flush=True)
+                    await asyncio.sleep(args.settle) # Let retransmission timers and the collector go quiet
+    finally:
+        # Tunnelled sessions are still open at this point; silence their teardown errors
+        logging.disable(logging.CRITICAL)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        origin.close()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+    print(f"Compression: {compression_stats.compressed_payloads}/{compression_stats.payloads} payloads compressed, "
+          f"ratio {compression_stats.ratio:.3f}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results, 'calls': dict(storage.call_counts)}, f, indent=2)
+    if args.metrics:
+        metrics.dump_metrics(args.metrics)
+    return results
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Drive tunnel against a local stand-in backend.")
+    parser.add_argument('--backend', choices=['memory', 'local'], default='memory',
+                        help="memory: in-process dict; local: temporary directory")
+    parser.add_argument('--sizes', type=parse_int_list, default=[1024, 64 * 1024, 1024 * 1024],
+                        help="Comma-separated payload sizes in bytes")
+    parser.add_argument('--connections', type=parse_int_list, default=[1, 4, 16],
+                        help="Comma-separated numbers of concurrent connections")
+    parser.add_argument('--latency', type=float, default=0.1, help="Simulated seconds per API call")
+    parser.add_argument('--jitter', type=float, default=0.05, help="Random extra seconds per API call (up to)")
+    parser.add_argument('--rate', type=float, default=None, help="API calls per second allowed (default: unlimited)")
+    parser.add_argument('--burst', type=int, default=10, help="Calls allowed in a burst above the rate")
+    parser.add_argument('--repeat', type=int, default=1, help="Runs per scenario")
+    parser.add_argument('--settle', type=float, default=1.0, help="Seconds to wait between scenarios")
+    parser.add_argument('--timeout', type=float, default=300, help="Seconds before a scenario is aborted")
+    parser.add_argument('--random-payload', action='store_true',
+                        help="Serve incompressible payloads (default: a highly compressible pattern)")
+    parser.add_argument('--json', help="Also write the results to this JSON file")
+    parser.add_argument('--metrics', help="Write the stage timings and other metrics (text format) to this file")
+    parser.add_argument('--verbose', action='store_true', help="Keep the client/server INFO logs")
+    args = parser.parse_args()
+
+    global BODY_PATTERN
+    if args.random_payload:
+        BODY_PATTERN = RANDOM_PATTERN
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    asyncio.run(run_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import struct
+import uuid
+from collections import namedtuple
+
+from tunnel_logging import debug_tracebacks
+
+# --- Bundle File Format ---
+# A bundle is the plaintext of one encrypted Drive file. It carries any number of
+# frames, possibly from many different SOCKS5 sessions, so a single upload or
+# download moves traffic for every active connection at once.
+#
+# Bundle header:
+#   MAGIC (4 bytes, b'GDVB') | VERSION (1 byte) | FRAME_COUNT (2 bytes) | CODECS (1 byte)
+# Followed by FRAME_COUNT frames, each:
+#   TYPE (1 byte) | CODEC (1 byte) | SESSION_ID (16 bytes, UUID) | SEQ (4 bytes) | ACK (4 bytes) | LENGTH (4 bytes) | PAYLOAD (LENGTH bytes)
+#
+# SEQ is the per-session, per-direction sequence number of the frame.
+# ACK is a cumulative acknowledgement for the opposite direction (0 when unused).
+# CODEC is the compression codec of the payload, and CODECS the bitmask of codecs the
+# sender of the bundle can decompress (see compression.py).
+# All integers are big-endian (network byte order).
+# Version 1 bundles (no CODECS byte, no per-frame CODEC byte) are still decoded.
+#
+# Session lifecycle (version 3): a session starts with an OPEN frame whose payload is
+#   ADDR_LEN (1 byte) | PORT (2 bytes) | ADDR (ADDR_LEN bytes, UTF-8)
+# naming the destination once; DATA frames then carry only the session's bytes
+# (before version 3 every DATA payload started with that address header). FIN
+# half-closes the sender's direction, CLOSE ends the session in both directions.
+# Control frames are sequenced like DATA frames, so they take effect in order.
+
+BUNDLE_MAGIC = b'GDVB'
+BUNDLE_VERSION = 3
+
+# Frame types
+FRAME_DATA = 0x00 # Payload bytes of a session
+FRAME_OPEN = 0x01 # Opens a session
+FRAME_CLOSE = 0x02 # Closes a session
+FRAME_ACK = 0x03 # Acknowledgement only, no payload
+FRAME_FIN = 0x04 # The sender will send no more data (half-close)
+
+FRAME_TYPES = (FRAME_DATA, FRAME_OPEN, FRAME_CLOSE, FRAME_ACK, FRAME_FIN)
+
+_BUNDLE_HEADER = struct.Struct('!4sBHB')
+_FRAME_HEADER = struct.Struct('!BB16sIII')
+_BUNDLE_HEADER_V1 = struct.Struct('!4sBH')
+_FRAME_HEADER_V1 = struct.Struct('!B16sIII')
+_OPEN_HEADER = struct.Struct('!BH')
+FRAME_OVERHEAD = _FRAME_HEADER.size # Bytes a frame adds on top of its payload
+MAX_FRAMES_PER_BUNDLE = 0xFFFF
+
+# A single frame of a bundle. session_id is the session's UUID string (as used in client.py);
+# codec tells how the payload is compressed (0: not compressed).
+Frame = namedtuple('Frame', ['frame_type', 'session_id', 'seq', 'ack', 'payload', 'codec'], defaults=(0, b'', 0))
+
+
+class BundleFormatError(ValueError):
+    """
+    Raised when a bundle cannot be decoded (wrong magic, unknown version, truncated data).
+    """
+
+
+def encode_bundle(frames, codecs_mask=0):
+    """
+    Encodes a list of Frame objects into the bytes of one bundle.
+    codecs_mask advertises the compression codecs the sender can decompress.
+    """
+    if len(frames) > MAX_FRAMES_PER_BUNDLE:
+        raise BundleFormatError(f"Too many frames for one bundle: {len(frames)}")
+    parts = [_BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, len(frames), codecs_mask)]
+    for frame in frames:
+        payload = frame.payload
+        parts.append(_FRAME_HEADER.pack(frame.frame_type, frame.codec, uuid.UUID(frame.session_id).bytes,
+                                        frame.seq, frame.ack, len(payload)))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def decode_bundle_header(data):
+    """
+    Decodes the header of a bundle. Returns (version, frame_count, codecs_mask, header_size);
+    codecs_mask is 0 for version 1 bundles. Raises BundleFormatError for invalid headers.
+    """
+    if len(data) < _BUNDLE_HEADER_V1.size:
+        raise BundleFormatError("Bundle too short")
+    magic, version, frame_count = _BUNDLE_HEADER_V1.unpack_from(data, 0)
+    if magic != BUNDLE_MAGIC:
+        raise BundleFormatError("Not a bundle (bad magic)")
+    if version == 1:
+        return version, frame_count, 0, _BUNDLE_HEADER_V1.size
+    if version not in (2, BUNDLE_VERSION): # Version 2 frames are laid out like version 3 frames
+        raise BundleFormatError(f"Unsupported bundle version: {version}")
+    if len(data) < _BUNDLE_HEADER.size:
+        raise BundleFormatError("Bundle too short")
+    codecs_mask = _BUNDLE_HEADER.unpack_from(data, 0)[3]
+    return version, frame_count, codecs_mask, _BUNDLE_HEADER.size
+
+
+def decode_bundle(data):
+    """
+    Decodes the bytes of one bundle into a list of Frame objects, in encoding order.
+    Raises BundleFormatError if the data is not a valid bundle.
+    """
+    view = memoryview(data)
+    version, frame_count, _, offset = decode_bundle_header(view)
+    frame_header = _FRAME_HEADER_V1 if version == 1 else _FRAME_HEADER
+
+    frames = []
+    for _ in range(frame_count):
+        if offset + frame_header.size > len(view):
+            raise BundleFormatError("Truncated frame header")
+        if version != 1:
+            frame_type, codec, session_bytes, seq, ack, length = frame_header.unpack_from(view, offset)
+        else:
+            frame_type, session_bytes, seq, ack, length = frame_header.unpack_from(view, offset)
+            codec = 0
+        offset += frame_header.size
+        if frame_type not in FRAME_TYPES:
+            raise BundleFormatError(f"Unknown frame type: {frame_type}")
+        if offset + length > len(view):
+            raise BundleFormatError("Truncated frame payload")
+        payload = bytes(view[offset : offset + length])
+        offset += length
+        frames.append(Frame(frame_type, str(uuid.UUID(bytes=session_bytes)), seq, ack, payload, codec))
+    if offset != len(view):
+        raise BundleFormatError("Trailing bytes after last frame")
+    return frames
+
+
+def encode_open_payload(dest_addr, dest_port):
+    """
+    Encodes the destination of a session as the payload of its OPEN frame.
+    """
+    addr_bytes = dest_addr.encode('utf-8')
+    if len(addr_bytes) > 0xFF:
+        raise BundleFormatError(f"Destination address too long: {dest_addr}")
+    return _OPEN_HEADER.pack(len(addr_bytes), dest_port) + addr_bytes
+
+
+def decode_open_payload(payload):
+    """
+    Decodes the payload of an OPEN frame. Returns (dest_addr, dest_port).
+    """
+    if len(payload) < _OPEN_HEADER.size:
+        raise BundleFormatError("OPEN payload too short")
+    addr_len, dest_port = _OPEN_HEADER.unpack_from(payload, 0)
+    addr_bytes = payload[_OPEN_HEADER.size:]
+    if len(addr_bytes) != addr_len:
+        raise BundleFormatError("OPEN payload has a bad address length")
+    return addr_bytes.decode('utf-8'), dest_port
+
+
+class BundleBatcher:
+    """
+    Gathers frames from any number of sessions and hands them to flush_callback
+    as one list (one bundle) once max_bytes are buffered or max_delay seconds have
+    passed since the first buffered frame. Flushes run one at a time from a single
+    task, so bundles are emitted in order; frames added while a flush is in progress
+    go into the next bundle. add() waits while more than max_pending_bytes are buffered.
+    """
+
+    def __init__(self, flush_callback, max_bytes, max_delay, max_pending_bytes=None):
+        self.flush_callback = flush_callback # async def flush_callback(frames)
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.max_pending_bytes = max_pending_bytes or 4 * max_bytes
+        self._frames = []
+        self._size = 0
+        self._pending = asyncio.Event() # At least one frame is buffered
+        self._full = asyncio.Event() # max_bytes reached, flush without waiting for the deadline
+        self._room = asyncio.Event() # Buffer is below max_pending_bytes
+        self._room.set()
+        self._flushing = False # A flush_callback call is in progress
+
+    @property
+    def idle(self):
+        """
+        True when no frame is buffered or being flushed (the batcher can be stopped).
+        """
+        return not self._frames and not self._flushing
+
+    async def add(self, frame):
+        """
+        Buffers a frame for the next bundle.
+        """
+        while not self._room.is_set():
+            await self._room.wait()
+        self._frames.append(frame)
+        self._size += FRAME_OVERHEAD + len(frame.payload)
+        self._pending.set()
+        if self._size >= self.max_bytes or len(self._frames) >= MAX_FRAMES_PER_BUNDLE:
+            self._full.set()
+        if self._size >= self.max_pending_bytes:
+            self._room.clear()
+
+    def _take_frames(self):
+        """
+        Removes and returns the frames of the next bundle: at least one frame, and
+        no more once max_bytes is reached.
+        """
+        count = 0
+        size = 0
+        while count < len(self._frames) and count < MAX_FRAMES_PER_BUNDLE and size < self.max_bytes:
+            size += FRAME_OVERHEAD + len(self._frames[count].payload)
+            count += 1
+        frames = self._frames[:count]
+        self._frames = self._frames[count:]
+        self._size = sum(FRAME_OVERHEAD + len(f.payload) for f in self._frames)
+        if not self._frames:
+            self._pending.clear()
+        if self._size < self.max_bytes and len(self._frames) < MAX_FRAMES_PER_BUNDLE:
+            self._full.clear()
+        if self._size < self.max_pending_bytes:
+            self._room.set()
+        return frames
+
+    async def run(self):
+        """
+        Flush loop; run it as a background task for the lifetime of the batcher.
+        """
+        while True:
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            frames = self._take_frames()
+            if frames:
+                self._flushing = True
+                try:
+                    await self.flush_callback(frames)
+                except Exception as e:
+                    logging.error(f"Bundle flush of {len(frames)} frames failed: {e}", exc_info=debug_tracebacks())
+                finally:
+                    self._flushing = False
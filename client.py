@@ -7,10 +7,20 @@ import logging
 
 from drive_utils_requests import (
     encrypt_data, decrypt_data,
-    upload_file, download_file,
-    list_files_in_folder, delete_file,
     get_token # Although not directly used here, it ensures token validity
 )
+from storage_backends import create_storage_backend
+from poll_scheduler import AdaptivePoller
+from packet_gc import PacketCollector
+from reliable_transport import ReliableChannel, service_channels
+from bundle_format import (
+    FRAME_DATA, FRAME_OPEN, FRAME_FIN, FRAME_CLOSE, BundleBatcher,
+    encode_bundle, decode_bundle, decode_bundle_header, encode_open_payload, BundleFormatError,
+)
+from compression import LOCAL_CODECS_MASK, DEFAULT_PEER_CODECS_MASK, compress_for_peer, decompress_payload
+import metrics
+from metrics import time_stage, observe_stage, observe_list_lag
+from tunnel_logging import setup_logging, trace, sampler, debug_tracebacks
 
 # --- Client Configuration ---
 SOCKS_LISTEN_HOST = '127.0.0.1' # Listen on localhost
@@ -22,20 +32,138 @@ SOCKS_LISTEN_PORT = 1080      # Standard SOCKS5 port
 REQUESTS_FOLDER_ID = '1CtHCatylPW-Llfoj17vNaLETMPlyjfPt' # Folder where client uploads requests
 RESPONSES_FOLDER_ID = '1a4E5NitMH5rn0Feu02uZrfa4KvI1vR3O' # Folder where client downloads responses
 
-# Logging setup
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Outbound packet coalescing: bytes read from the SOCKS5 client are gathered until
+# COALESCE_MAX_BYTES are buffered or COALESCE_DELAY seconds have passed since the
+# first byte arrived, and are then uploaded as a single packet.
+COALESCE_MAX_BYTES = 64 * 1024
+COALESCE_DELAY = 0.05
+
+# Request bundling: frames of all sessions are packed into one bundle file
+# (see bundle_format.py) once BUNDLE_MAX_BYTES are buffered or BUNDLE_MAX_DELAY
+# seconds have passed since the first buffered frame.
+BUNDLE_MAX_BYTES = 256 * 1024
+BUNDLE_MAX_DELAY = 0.05
+
+# Discover new files through the Drive changes feed (list_new_files) instead of
+# listing the whole folder on every poll; API cost then tracks new traffic, not folder size
+USE_CHANGES_FEED = False
+
+# Adaptive polling of the Drive folder (see poll_scheduler.py): every POLL_MIN_INTERVAL
+# seconds while data is moving (and for POLL_BURST_DURATION seconds after), backing off
+# by POLL_BACKOFF_FACTOR per empty poll up to POLL_MAX_INTERVAL seconds while idle.
+POLL_MIN_INTERVAL = 0.15
+POLL_MAX_INTERVAL = 5.0
+POLL_BACKOFF_FACTOR = 2.0
+POLL_BURST_DURATION = 2.0
+
+# Up to RESPONSE_PREFETCH_WINDOW response bundles are downloaded concurrently
+RESPONSE_PREFETCH_WINDOW = 8
+
+# Reliable transport (see reliable_transport.py): at most RELIABLE_WINDOW unacknowledged
+# packets in flight per session; unacknowledged packets are retransmitted after a timeout
+# starting at RELIABLE_INITIAL_RTO seconds and adapted to the measured round-trip time
+RELIABLE_WINDOW = 64
+RELIABLE_INITIAL_RTO = 10.0
+
+# After a session ends, its reliable channel is kept for up to SESSION_LINGER seconds
+# so the CLOSE frame (or the server's last frames) still get acknowledged and retransmitted
+SESSION_LINGER = 120
+
+# Sessions without traffic in either direction for this many seconds are closed
+# (e.g. the server dropped the session without its CLOSE frame getting through)
+SESSION_IDLE_TIMEOUT = 300
+
+COMPRESSION_ENABLED = True # Compress frame payloads before encryption (see compression.py)
+
+# Garbage collection of consumed packet files (see packet_gc.py): deletions are
+# batched every GC_FLUSH_INTERVAL seconds; files this side uploaded that are still
+# unconsumed after ORPHAN_MAX_AGE seconds are swept every GC_SWEEP_INTERVAL seconds
+GC_FLUSH_INTERVAL = 1.0
+GC_SWEEP_INTERVAL = 300
+ORPHAN_MAX_AGE = 900
+
+# Metrics (see metrics.py): served in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics (None disables the endpoint), and written to
+# METRICS_DUMP_FILE every METRICS_DUMP_INTERVAL seconds if a file is set
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
+METRICS_DUMP_FILE = None
+METRICS_DUMP_INTERVAL = 60
+
+# Logging (see tunnel_logging.py): records are written by a background thread, to
+# LOG_FILE if set. LOG_LEVEL 'TRACE' also logs every packet and bundle (costly at high rates)
+LOG_LEVEL = 'INFO'
+LOG_FILE = None
+setup_logging(LOG_LEVEL, LOG_FILE)
 
 # Dictionary to keep track of active SOCKS5 sessions
-# key: session_id, value: {'writer': asyncio.StreamWriter, 'last_packet_id': int}
+# key: session_id, value: {'writer': asyncio.StreamWriter, 'last_packet_id': int,
+#                          'queue': asyncio.Queue of response frames filled by dispatch_responses,
+#                          'channel': ReliableChannel of the session,
+#                          'closed_by_peer': bool, True once the server sent CLOSE,
+#                          'last_activity': float,
+#                          'server_id': str, ID of the server answering the session (None until it has)}
 active_sessions = {} 
 
+# Ended sessions whose channel lingers until everything is acknowledged (see SESSION_LINGER)
+# key: session_id, value: {'channel': ReliableChannel, 'ended_at': float}
+closing_sessions = {}
+
+# Unique ID of this client process, used in request bundle file names and as the
+# context of the key its bundles are encrypted with (see encrypt_data)
+CLIENT_ID = uuid.uuid4().hex
+bundle_counter = 0
+
+# BundleBatcher shared by all sessions, created by start_client()
+request_batcher = None
+
+# Compression codecs each server can decompress, as advertised in the last bundle received from it
+# key: server ID, value: codecs mask (DEFAULT_PEER_CODECS_MASK for servers not heard from)
+peer_codecs_masks = {}
+
+# Storage the packet files go through (see storage_backends.py): Google Drive, through the
+# asyncio Drive client when aiohttp is installed; replace it with another StorageBackend
+# (e.g. a LocalDirectoryStorageBackend) to run without Google Drive
+storage = create_storage_backend('drive', use_changes_feed=USE_CHANGES_FEED)
+
+# Background collector deleting consumed response bundles (and orphaned request bundles)
+packet_collector = PacketCollector(storage, flush_interval=GC_FLUSH_INTERVAL, sweep_folders=[REQUESTS_FOLDER_ID],
+                                   sweep_interval=GC_SWEEP_INTERVAL, orphan_max_age=ORPHAN_MAX_AGE)
+
+# Response bundles being downloaded (key: file id, value: asyncio.Task) and the
+# semaphore bounding concurrent downloads, created by dispatch_responses()
+prefetch_in_flight = {}
+prefetch_semaphore = None
+
+# Poll scheduler of the shared response poller
+response_poller = AdaptivePoller(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF_FACTOR, POLL_BURST_DURATION)
+
+async def upload_request_bundle(frames):
+    """
+    Encrypts the frames of all sessions gathered by the request batcher as one
+    bundle and uploads it to the _requests folder.
+    """
+    global bundle_counter
+    bundle_counter += 1
+    # File name format: ClientID_BundleID.bundle.enc (zero-padded so names sort in upload order)
+    file_name = f"{CLIENT_ID}_{bundle_counter:010d}.bundle.enc"
+    with time_stage('encrypt'):
+        encrypted_bundle = encrypt_data(encode_bundle(frames, LOCAL_CODECS_MASK), context=CLIENT_ID.encode())
+    trace("Client: Uploading bundle %d (%d frames, %d bytes)", bundle_counter, len(frames), len(encrypted_bundle))
+    with time_stage('upload'):
+        file_id = await storage.upload(file_name, encrypted_bundle, REQUESTS_FOLDER_ID)
+    if not file_id:
+        logging.error(f"Client: Failed to upload bundle {bundle_counter}")
+    else:
+        response_poller.notify_activity() # A response is expected soon, poll aggressively
+
 async def handle_socks5_request(reader, writer):
     """
     Handles incoming SOCKS5 proxy requests from the client (e.g., browser).
     Performs SOCKS5 handshake and then starts the data tunneling process.
     """
     peername = writer.get_extra_info('peername')
-    logging.info(f"Accepted connection from {peername}")
+    logging.debug(f"Accepted connection from {peername}")
     session_id = None # Initialize session_id for finally block
 
     try:
@@ -102,13 +230,25 @@ async def handle_socks5_request(reader, writer):
         # --- Start Data Tunneling via Google Drive ---
         # Generate a unique session ID for this SOCKS5 connection
         session_id = str(uuid.uuid4())
-        active_sessions[session_id] = {'writer': writer, 'last_packet_id': 0}
+        active_sessions[session_id] = {
+            'writer': writer,
+            'last_packet_id': 0,
+            'queue': asyncio.Queue(),
+            'channel': ReliableChannel(session_id, request_batcher.add, RELIABLE_WINDOW, RELIABLE_INITIAL_RTO),
+            'closed_by_peer': False,
+            'last_activity': time.monotonic(),
+            'server_id': None,
+        }
+        metrics.active_sessions.inc(side='client')
+
+        # The OPEN frame names the destination once; the server connects when it applies it
+        await active_sessions[session_id]['channel'].send(FRAME_OPEN, encode_open_payload(dest_addr, dest_port))
         
         logging.info(f"Tunnel established for {dest_addr}:{dest_port} with session ID {session_id}")
         
         # Run send and receive tasks concurrently
         await asyncio.gather(
-            send_data_to_drive(reader, session_id, dest_addr, dest_port),
+            send_data_to_drive(reader, session_id),
             receive_data_from_drive(writer, session_id)
         )
 
@@ -118,125 +258,287 @@ async def handle_socks5_request(reader, writer):
     except ConnectionResetError:
         logging.warning(f"Client {peername} disconnected unexpectedly (ConnectionResetError).")
     except Exception as e:
-        logging.error(f"Error handling SOCKS5 connection from {peername}: {e}", exc_info=True)
+        logging.error(f"Error handling SOCKS5 connection from {peername}: {e}", exc_info=debug_tracebacks())
     finally:
         if session_id and session_id in active_sessions: # Check if session_id was successfully assigned
-            del active_sessions[session_id]
+            await end_session(session_id)
         if not writer.is_closing():
             writer.close()
         logging.info(f"Connection from {peername} closed. Session {session_id if session_id else 'N/A'} ended.")
 
-async def send_data_to_drive(reader, session_id, dest_addr, dest_port):
+async def end_session(session_id):
+    """
+    Removes an ended session, telling the server with a CLOSE frame unless the server
+    closed it. Its channel lingers in closing_sessions until everything is acknowledged.
+    """
+    session = active_sessions.pop(session_id)
+    metrics.active_sessions.dec(side='client')
+    for direction in ('out', 'in'):
+        metrics.session_bytes_total.remove(session=session_id, direction=direction)
+    channel = session['channel']
+    closing_sessions[session_id] = {'channel': channel, 'ended_at': time.monotonic()}
+    if not session['closed_by_peer'] and not channel.failed:
+        try:
+            await channel.send(FRAME_CLOSE, wait_for_window=False) # Never hold up closing the SOCKS5 connection
+        except Exception as e:
+            logging.warning(f"Client {session_id}: Could not send CLOSE: {e}")
+
+def close_idle_sessions():
+    """
+    Ends sessions that have seen no traffic in either direction for SESSION_IDLE_TIMEOUT
+    seconds: their receive task is woken with None and closes the SOCKS5 connection.
+    """
+    now = time.monotonic()
+    for session_id, session in active_sessions.items():
+        if now - session['last_activity'] > SESSION_IDLE_TIMEOUT:
+            logging.info(f"Client {session_id}: Idle for {SESSION_IDLE_TIMEOUT}s, closing")
+            session['last_activity'] = now # Wake the receive task only once
+            session['queue'].put_nowait(None)
+
+def reap_closing_sessions():
+    """
+    Forgets ended sessions whose channel has nothing left in flight or owed (or gave up),
+    and any that lingered for longer than SESSION_LINGER seconds.
+    """
+    now = time.monotonic()
+    for session_id, closing in list(closing_sessions.items()):
+        channel = closing['channel']
+        if channel.idle or channel.failed or now - closing['ended_at'] > SESSION_LINGER:
+            del closing_sessions[session_id]
+
+async def read_coalesced(reader, max_bytes=None, delay=None):
+    """
+    Reads data from the SOCKS5 client, Nagle-style: waits for the first bytes, then
+    keeps gathering further writes until max_bytes are buffered or delay seconds have
+    passed, so many small writes become one packet. Returns b'' once the client has
+    closed the connection and nothing is buffered.
+    """
+    max_bytes = COALESCE_MAX_BYTES if max_bytes is None else max_bytes
+    delay = COALESCE_DELAY if delay is None else delay
+
+    data = await reader.read(max_bytes)
+    if not data:
+        return data
+
+    chunks = [data]
+    size = len(data)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + delay
+    while size < max_bytes:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            # StreamReader.read is cancellation-safe: unread bytes stay buffered on timeout
+            more = await asyncio.wait_for(reader.read(max_bytes - size), remaining)
+        except asyncio.TimeoutError:
+            break
+        if not more:
+            break # EOF: flush what we have, the next read reports the close
+        chunks.append(more)
+        size += len(more)
+    observe_stage('socks_read', loop.time() - started)
+    return b''.join(chunks)
+
+async def send_data_to_drive(reader, session_id):
     """
     Reads data from the SOCKS5 client (e.g., browser) and uploads it to Google Drive.
-    Each piece of data becomes an encrypted file in the _requests folder.
+    Data is coalesced (see read_coalesced) and each batch becomes a DATA frame that is
+    uploaded to the _requests folder inside a bundle shared with other sessions.
+    The session's reliable channel numbers the frames and retransmits lost ones.
+    When the SOCKS5 client stops sending, a FIN frame half-closes the destination connection.
     """
-    packet_id_counter = 0
+    session = active_sessions[session_id]
+    channel = session['channel']
     while True:
         try:
-            # Read data from the SOCKS5 client (e.g., browser)
-            data = await reader.read(4096) # Read up to 4KB of data
+            # Read (and coalesce) data from the SOCKS5 client (e.g., browser)
+            data = await read_coalesced(reader)
             if not data:
-                # Client closed connection
-                logging.info(f"Client {session_id}: No more data from reader, closing send task.")
+                # Client closed connection (or half-closed it); nothing to tell the server
+                # if the server closed the session itself
+                logging.debug(f"Client {session_id}: No more data from reader, closing send task.")
+                if not session['closed_by_peer']:
+                    await channel.send(FRAME_FIN)
                 break
 
-            packet_id_counter += 1
-            dest_addr_bytes = dest_addr.encode('utf-8')
-
-            # Internal Tunnel Protocol:
-            # First 1 byte: length of destination address (N)
-            # Next 2 bytes: destination port (P)
-            # Next N bytes: destination address (e.g., example.com)
-            # Remaining bytes: actual data
-            header = struct.pack('!BH', len(dest_addr_bytes), dest_port) + dest_addr_bytes
-            
-            full_packet = header + data # Combine header with actual data
-
-            encrypted_data = encrypt_data(full_packet) # Encrypt the combined packet
-            
-            # File name format: SessionID_PacketID.request.enc
-            file_name = f"{session_id}_{packet_id_counter}.request.enc"
-            
-            logging.info(f"Client {session_id}: Uploading packet {packet_id_counter} ({len(data)} bytes) for {dest_addr}:{dest_port}")
-            # The upload_file is a blocking call, so run it in a separate thread
-            await asyncio.to_thread(upload_file, file_name, encrypted_data, REQUESTS_FOLDER_ID)
-            # A short sleep can be added here to avoid flooding the Drive API if needed, e.g., await asyncio.sleep(0.1)
+            # The frame is uploaded together with other sessions' frames in the next request bundle
+            # (waits while the session's window of unacknowledged packets is full)
+            peer_mask = peer_codecs_masks.get(session['server_id'], DEFAULT_PEER_CODECS_MASK)
+            codec, payload = compress_for_peer(data, peer_mask, COMPRESSION_ENABLED)
+            packet_id = await channel.send(FRAME_DATA, payload, codec)
+            session['last_activity'] = time.monotonic()
+            metrics.session_bytes_total.inc(len(data), session=session_id, direction='out')
+            trace("Client %s: Queued packet %d (%d bytes)", session_id, packet_id, len(data))
         except ConnectionResetError:
             logging.warning(f"Client {session_id}: Connection reset by peer while sending data.")
             break
         except Exception as e:
-            logging.error(f"Client {session_id}: Error sending data to drive: {e}", exc_info=True)
+            logging.error(f"Client {session_id}: Error sending data to drive: {e}", exc_info=debug_tracebacks())
             break
 
-async def receive_data_from_drive(writer, session_id):
+async def fetch_response_bundle(file_info):
+    """
+    Downloads one response bundle (at most RESPONSE_PREFETCH_WINDOW at a time) and
+    routes its frames to the per-session queues as soon as it arrives.
+    """
+    try:
+        async with prefetch_semaphore:
+            # Download the response bundle
+            with time_stage('download'):
+                content_bytes = await storage.download(file_info['id'])
+        if content_bytes:
+            with time_stage('decrypt'):
+                decrypted_data = decrypt_data(content_bytes) # Decrypt the data
+            if decrypted_data:
+                try:
+                    frames = decode_bundle(decrypted_data)
+                    server_id = file_info['name'].split('_')[1] # Response bundles are named ClientID_ServerID_BundleID
+                    peer_codecs_masks[server_id] = decode_bundle_header(decrypted_data)[2]
+                except BundleFormatError as e:
+                    logging.error(f"Client: Malformed response bundle {file_info['name']}: {e}")
+                    frames = []
+                for frame in frames:
+                    session = active_sessions.get(frame.session_id)
+                    if session is None and frame.session_id in closing_sessions:
+                        # Ended session: only acknowledgements (and retransmissions to re-ack) matter
+                        closing_sessions[frame.session_id]['channel'].on_frame(frame)
+                        continue
+                    if session is None:
+                        sampler.log('unknown_session', logging.WARNING,
+                                    f"Client: Dropping response frame for unknown session {frame.session_id}")
+                        continue
+                    session['server_id'] = server_id
+                    session['queue'].put_nowait(frame)
+            else:
+                logging.error(f"Client: Failed to decrypt response bundle {file_info['name']}. Deleting.")
+        else:
+            logging.error(f"Client: Failed to download response bundle {file_info['name']}. Deleting.")
+    except Exception as e:
+        sampler.log('fetch_error', logging.ERROR, f"Client: Error fetching response bundle {file_info['name']}: {e}",
+                    exc_info=debug_tracebacks())
+    finally:
+        packet_collector.discard(file_info['id']) # Delete the bundle once routed (or unusable), off the data path
+        prefetch_in_flight.pop(file_info['id'], None)
+
+async def dispatch_responses():
     """
-    Monitors the _responses folder in Google Drive for new response files
-    and sends the decrypted data back to the SOCKS5 client (e.g., browser).
+    Single response poller shared by all sessions. Lists the _responses folder once
+    per tick and starts a download for each new response bundle addressed to this
+    client, so the number of list calls does not grow with the number of SOCKS5
+    connections. Downloads run
+    concurrently in the background (see fetch_response_bundle); each session puts
+    its packets back in order in receive_data_from_drive.
     """
-    last_processed_packet_id = 0 # To track which packets have already been sent
+    global prefetch_semaphore
+    prefetch_semaphore = asyncio.Semaphore(RESPONSE_PREFETCH_WINDOW)
+    logging.info(f"Client: Polling '_responses' folder (ID: {RESPONSES_FOLDER_ID}) for all sessions")
     while True:
         try:
             # List files in the responses folder
-            # The list_files_in_folder is a blocking call, so run it in a separate thread
-            files_response_list = await asyncio.to_thread(list_files_in_folder, RESPONSES_FOLDER_ID)
-            
-            # Filter files belonging to this session and sort by packet ID
-            session_files = []
-            for file_info in files_response_list:
-                if file_info['name'].startswith(f"{session_id}_") and file_info['name'].endswith('.response.enc'):
-                    try:
-                        # Extract PacketID from file name (e.g., "sessionID_PacketID.response.enc")
-                        parts = file_info['name'].split('_')
-                        if len(parts) > 1:
-                            current_packet_id = int(parts[1].split('.')[0])
-                            session_files.append((current_packet_id, file_info))
-                    except (ValueError, IndexError):
-                        logging.warning(f"Client {session_id}: Malformed response file name: {file_info['name']}. Deleting.")
-                        await asyncio.to_thread(delete_file, file_info['id']) # Delete corrupted file
-                        continue
-            
-            # Sort files by their Packet ID to ensure correct order of delivery
-            session_files.sort(key=lambda x: x[0]) 
-
-            for current_packet_id, file_info in session_files:
-                if current_packet_id > last_processed_packet_id:
-                    logging.info(f"Client {session_id}: Found response packet {current_packet_id} ({file_info['name']})")
-                    
-                    # Download the response file
-                    content_bytes = await asyncio.to_thread(download_file, file_info['id'])
-                    if content_bytes:
-                        decrypted_data = decrypt_data(content_bytes) # Decrypt the data
-                        if decrypted_data:
-                            writer.write(decrypted_data) # Send to SOCKS5 client
-                            await writer.drain() # Ensure data is written
-                            await asyncio.to_thread(delete_file, file_info['id']) # Delete file after successful processing
-                            last_processed_packet_id = current_packet_id # Update last processed packet ID
-                        else:
-                            logging.error(f"Client {session_id}: Failed to decrypt response for {file_info['name']}. Deleting.")
-                            await asyncio.to_thread(delete_file, file_info['id']) # Delete if decryption fails
-                    else:
-                        logging.error(f"Client {session_id}: Failed to download response for {file_info['name']}. Deleting.")
-                        await asyncio.to_thread(delete_file, file_info['id']) # Delete if download fails
-            
-            await asyncio.sleep(1) # Check for new files every 1 second
+            # (only the files added since the last poll when the backend follows a changes feed)
+            files_response_list = await storage.list_new_files(RESPONSES_FOLDER_ID)
+
+            # Only bundles addressed to this client (ClientID_ServerID_BundleID.bundle.enc) are ours to
+            # download and delete; the folder is shared with other clients of the same server.
+            # Bundles already consumed may still be listed until the collector has deleted them,
+            # and bundles being downloaded are listed until they are consumed
+            bundle_files = [f for f in files_response_list
+                            if f['name'].startswith(f"{CLIENT_ID}_") and f['name'].endswith('.bundle.enc')
+                            and not packet_collector.is_collected(f['id']) and f['id'] not in prefetch_in_flight]
+            # Start downloads in upload order (the server's bundle counter is zero-padded)
+            bundle_files.sort(key=lambda x: (x['createdTime'], x['name']))
+
+            for file_info in bundle_files:
+                observe_list_lag(file_info['createdTime'])
+                prefetch_in_flight[file_info['id']] = asyncio.create_task(fetch_response_bundle(file_info))
+
+            close_idle_sessions()
+            reap_closing_sessions()
+            # Poll fast while responses are flowing, back off while idle
+            response_poller.record_poll(bool(bundle_files))
+            metrics.poll_interval_seconds.set(response_poller.current_interval, folder='responses')
+            await response_poller.sleep()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            sampler.log('poll_error', logging.ERROR, f"Client: Error polling responses from drive: {e}",
+                        exc_info=debug_tracebacks())
+            await asyncio.sleep(5) # Wait before retrying on network/API errors
+
+async def receive_data_from_drive(writer, session_id):
+    """
+    Consumes the response frames routed to this session by dispatch_responses
+    and sends the data back to the SOCKS5 client (e.g., browser).
+    Bundles are downloaded concurrently, so frames can arrive out of order or twice:
+    the session's reliable channel reorders them, drops duplicates and acknowledges them.
+    """
+    session = active_sessions[session_id]
+    channel = session['channel']
+    while True:
+        try:
+            frame = await session['queue'].get()
+            if frame is None: # Closed by close_idle_sessions
+                break
+            session['last_activity'] = time.monotonic()
+            for delivered in channel.on_frame(frame):
+                if delivered.frame_type == FRAME_CLOSE:
+                    # The destination closed the connection and everything before it was delivered
+                    session['closed_by_peer'] = True
+                    logging.info(f"Client {session_id}: Closed by the server")
+                    break
+                if delivered.frame_type != FRAME_DATA:
+                    continue
+                data = decompress_payload(delivered.codec, delivered.payload)
+                trace("Client %s: Received response packet %d (%d bytes)", session_id, delivered.seq, len(data))
+                metrics.session_bytes_total.inc(len(data), session=session_id, direction='in')
+                writer.write(data) # Send to SOCKS5 client
+                await writer.drain() # Ensure data is written
+                session['last_packet_id'] = delivered.seq # Update last processed packet ID
+            if session['closed_by_peer']:
+                break
         except ConnectionResetError:
             logging.warning(f"Client {session_id}: Connection reset by peer while receiving.")
             break
         except Exception as e:
-            logging.error(f"Client {session_id}: Error receiving data from drive: {e}", exc_info=True)
+            logging.error(f"Client {session_id}: Error receiving data from drive: {e}", exc_info=debug_tracebacks())
             break
     if not writer.is_closing():
         writer.close() # Close the writer (connection to the SOCKS5 client) when the loop ends
 
-async def start_client():
-    """Starts the SOCKS5 proxy server."""
-    logging.info(f"Starting SOCKS5 proxy on {SOCKS_LISTEN_HOST}:{SOCKS_LISTEN_PORT}")
+async def start_client(host=None, port=None):
+    """Starts the SOCKS5 proxy server (on SOCKS_LISTEN_HOST:SOCKS_LISTEN_PORT unless given)."""
+    global request_batcher
+    host = SOCKS_LISTEN_HOST if host is None else host
+    port = SOCKS_LISTEN_PORT if port is None else port
+    request_batcher = BundleBatcher(upload_request_bundle, BUNDLE_MAX_BYTES, BUNDLE_MAX_DELAY)
+    batcher_task = asyncio.create_task(request_batcher.run())
+    dispatcher_task = asyncio.create_task(dispatch_responses())
+    collector_task = asyncio.create_task(packet_collector.run())
+    # Retransmission and delayed-ACK timers of all sessions' reliable channels
+    timers_task = asyncio.create_task(service_channels(
+        lambda: [s['channel'] for s in active_sessions.values()] + [s['channel'] for s in closing_sessions.values()]))
+    metrics_server = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    dump_task = (asyncio.create_task(metrics.dump_metrics_periodically(METRICS_DUMP_FILE, METRICS_DUMP_INTERVAL))
+                 if METRICS_DUMP_FILE else None)
+
+    logging.info(f"Starting SOCKS5 proxy on {host}:{port}")
     # Start the asyncio server that handles incoming SOCKS5 connections
-    server = await asyncio.start_server(handle_socks5_request, SOCKS_LISTEN_HOST, SOCKS_LISTEN_PORT)
+    server = await asyncio.start_server(handle_socks5_request, host, port)
     
-    async with server:
-        await server.serve_forever()
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batcher_task.cancel()
+        dispatcher_task.cancel()
+        collector_task.cancel()
+        timers_task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        if dump_task is not None:
+            dump_task.cancel()
 
 if __name__ == '__main__':
     # Run the client (SOCKS5 proxy)
@@ -0,0 +1,153 @@
+import zlib
+
+import metrics
+
+# Optional codecs: used when the package is installed on both ends of the tunnel
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# --- Payload Compression ---
+# Frame payloads are compressed before they are handed to the reliable channel (and
+# thus before encryption); the codec used is stored in the frame (see bundle_format.py).
+# Every bundle header advertises the codecs its sender can decompress, so each side
+# picks the best codec the peer supports. zlib is always available.
+#
+# Payloads that do not shrink are sent as they are: TLS records (the bulk of HTTPS
+# traffic) are skipped right away, and other payloads are first trial-compressed on a
+# sample, so already compressed data (images, video, archives) costs little CPU.
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_BROTLI = 3
+
+# Codecs this process can use, best first
+AVAILABLE_CODECS = [codec for codec, module in ((CODEC_ZSTD, zstandard), (CODEC_BROTLI, brotli), (CODEC_ZLIB, zlib)) if module]
+
+COMPRESS_MIN_SIZE = 256 # Smaller payloads are not worth compressing
+COMPRESS_SAMPLE_SIZE = 4096 # Bytes trial-compressed to decide whether a payload is compressible
+COMPRESS_MAX_RATIO = 0.9 # Compressed data is only used if it is at most this fraction of the original
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+BROTLI_QUALITY = 5
+
+
+def codecs_mask(codecs=None):
+    """
+    Bitmask of codecs (bit n set: codec n supported), as advertised in bundle headers.
+    """
+    mask = 0
+    for codec in AVAILABLE_CODECS if codecs is None else codecs:
+        mask |= 1 << codec
+    return mask
+
+
+LOCAL_CODECS_MASK = codecs_mask()
+DEFAULT_PEER_CODECS_MASK = codecs_mask([CODEC_ZLIB]) # Until the peer has advertised its codecs
+
+
+def choose_codec(peer_mask):
+    """
+    Returns the best codec both this process and the peer (given by its mask) support.
+    """
+    for codec in AVAILABLE_CODECS:
+        if peer_mask & (1 << codec):
+            return codec
+    return CODEC_NONE
+
+
+def _compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if codec == CODEC_BROTLI:
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def decompress_payload(codec, payload):
+    """
+    Reverses compress_payload. Raises ValueError for codecs this process does not support.
+    """
+    if codec == CODEC_NONE:
+        return payload
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    if codec == CODEC_ZSTD and zstandard:
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if codec == CODEC_BROTLI and brotli:
+        return brotli.decompress(payload)
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def _is_tls_record(data):
+    # TLS record header: content type 20-23, protocol version 3.x
+    return len(data) >= 5 and 20 <= data[0] <= 23 and data[1] == 3
+
+
+class CompressionStats:
+    """
+    Running totals of the compression stage, e.g. for metrics.
+    """
+
+    def __init__(self):
+        self.payloads = 0
+        self.compressed_payloads = 0
+        self.bytes_in = 0 # Payload bytes before compression
+        self.bytes_out = 0 # Payload bytes after compression (or unchanged)
+
+    def record(self, size_in, size_out, compressed):
+        self.payloads += 1
+        self.compressed_payloads += 1 if compressed else 0
+        self.bytes_in += size_in
+        self.bytes_out += size_out
+
+    @property
+    def ratio(self):
+        """
+        Output bytes per input byte over all payloads (1.0 = no saving).
+        """
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+
+compression_stats = CompressionStats()
+metrics.compression_ratio.set_function(lambda: compression_stats.ratio)
+
+
+def compress_payload(data, codec):
+    """
+    Compresses a frame payload with the given codec if that pays off.
+    Returns (codec_used, payload); codec_used is CODEC_NONE if the data was left as is.
+    """
+    if codec == CODEC_NONE or len(data) < COMPRESS_MIN_SIZE or _is_tls_record(data):
+        compression_stats.record(len(data), len(data), False)
+        return CODEC_NONE, data
+    if len(data) > 2 * COMPRESS_SAMPLE_SIZE:
+        sample = data[:COMPRESS_SAMPLE_SIZE]
+        if len(zlib.compress(sample, 1)) > COMPRESS_MAX_RATIO * len(sample):
+            compression_stats.record(len(data), len(data), False)
+            return CODEC_NONE, data # Looks incompressible (high entropy)
+    compressed = _compress(codec, data)
+    if len(compressed) > COMPRESS_MAX_RATIO * len(data):
+        compression_stats.record(len(data), len(data), False)
+        return CODEC_NONE, data
+    compression_stats.record(len(data), len(compressed), True)
+    return codec, compressed
+
+
+def compress_for_peer(data, peer_mask, enabled=True):
+    """
+    Compresses a frame payload with the best codec both this process and the peer
+    (given by the codecs mask it advertised) support, if that pays off.
+    Returns (codec, payload); nothing is compressed unless enabled.
+    """
+    if not enabled:
+        return CODEC_NONE, data
+    return compress_payload(data, choose_codec(peer_mask))
@@ -0,0 +1,124 @@
+import asyncio
+
+try:
+    import aiohttp # Optional: without it the tunnel runs the blocking Drive calls in threads
+except ImportError:
+    aiohttp = None
+
+import drive_utils_requests
+from drive_utils_requests import (
+    RESUMABLE_UPLOAD_THRESHOLD, DRIVE_POOL_SIZE, DRIVE_MAX_RETRIES, PRIORITY_DATA,
+    DriveResponse, rate_limiter, token_cache,
+)
+
+# --- Async Drive Client ---
+# Runs the Drive operations of drive_utils_requests (list, upload, download, delete,
+# batch delete) as coroutines over one pooled aiohttp session, so many concurrent Drive
+# calls do not each occupy a worker thread. The operations themselves, the rate limiter
+# and the retry policy are the ones the blocking functions use, which stay available
+# for scripts and for installs without aiohttp.
+
+DRIVE_ASYNC_TIMEOUT = 120 # Seconds per HTTP request
+
+
+class AsyncDriveClient:
+    """
+    Drive API client running on the event loop. One aiohttp session (created on first
+    use, inside the running loop) keeps up to pool_size connections to googleapis.com alive.
+    """
+
+    def __init__(self, pool_size=DRIVE_POOL_SIZE):
+        if aiohttp is None:
+            raise RuntimeError("drive_async requires the aiohttp package (pip install aiohttp)")
+        self.pool_size = pool_size
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=DRIVE_ASYNC_TIMEOUT))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def request(self, method, url, priority=PRIORITY_DATA, max_retries=DRIVE_MAX_RETRIES, **kwargs):
+        """
+        Sends an authorized request and returns a DriveResponse. Every attempt takes a
+        token from the process-wide rate limiter, and failed attempts are retried as
+        drive_utils_requests._retry_delay decides, like DriveTransport.request.
+        """
+        extra_headers = kwargs.pop('headers', None) or {}
+        attempt = 0
+        while True:
+            await rate_limiter.acquire_async(priority)
+            # Loading or refreshing the token blocks (file and network I/O): keep it off the event loop
+            token = token_cache.cached_token() or await asyncio.to_thread(drive_utils_requests.get_token)
+            headers = {"Authorization": f"Bearer {token}"}
+            headers.update(extra_headers)
+            try:
+                async with self._get_session().request(method, url, headers=headers, **kwargs) as raw:
+                    response = DriveResponse(raw.status, raw.headers, await raw.read())
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                delay = drive_utils_requests._retry_delay(method, url, None, None, None, attempt, max_retries)
+                if delay is None:
+                    raise
+            else:
+                delay = drive_utils_requests._retry_delay(method, url, response.status, response.headers,
+                                                          lambda: response.body, attempt, max_retries)
+                if delay is None:
+                    return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def run_operation(self, operation):
+        """
+        Runs a Drive operation generator (see drive_utils_requests) and returns its result.
+        """
+        response = None
+        while True:
+            try:
+                call = operation.send(response)
+            except StopIteration as done:
+                return done.value
+            response = await self.request(call.method, call.url, priority=call.priority, **call.options)
+
+    async def list_files_in_folder(self, folder_id, page_size=None, max_files=None):
+        """
+        Lists files within a folder (all pages, oldest first), at most max_files.
+        """
+        return await self.run_operation(drive_utils_requests._list_files_op(folder_id, page_size, max_files))
+
+    async def upload_file(self, file_name, content_bytes, folder_id, overwrite=True):
+        """
+        Uploads a file and returns its ID, or None; see drive_utils_requests.upload_file.
+        Files of RESUMABLE_UPLOAD_THRESHOLD bytes or more use the blocking resumable
+        upload in a thread.
+        """
+        if len(content_bytes) >= RESUMABLE_UPLOAD_THRESHOLD:
+            if overwrite:
+                await self.run_operation(drive_utils_requests._delete_existing_op(folder_id, file_name))
+            return await asyncio.to_thread(drive_utils_requests.upload_file_resumable, file_name, content_bytes, folder_id)
+        return await self.run_operation(drive_utils_requests._upload_file_op(file_name, content_bytes, folder_id, overwrite))
+
+    async def download_file(self, file_id):
+        """
+        Downloads a file by its ID and returns its content as bytes, or None.
+        """
+        return await self.run_operation(drive_utils_requests._download_file_op(file_id))
+
+    async def delete_file(self, file_id):
+        """
+        Deletes a file by its ID. Returns True if it was deleted or already gone (404).
+        """
+        return await self.run_operation(drive_utils_requests._delete_file_op(file_id))
+
+    async def delete_files_batch(self, file_ids):
+        """
+        Deletes many files with batch requests (up to BATCH_MAX_REQUESTS per request).
+        Returns a dict mapping each file ID to True if it was deleted or already gone.
+        """
+        return await self.run_operation(drive_utils_requests._delete_files_batch_op(file_ids))
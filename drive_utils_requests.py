@@ -1,11 +1,25 @@
 import os
 import json
+import asyncio
 import base64
 import time
+import datetime
+import threading
+import uuid
+import heapq
+import itertools
+import random
+import email.utils
+from collections import namedtuple
 import requests
+from requests.adapters import HTTPAdapter
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request as GoogleAuthRequest # Renamed to avoid conflict with requests.Request
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from metrics import api_calls_total, operation_of
 
 # Set SSL_CERT_FILE environment variable for proper SSL certificate handling.
 # This ensures Python uses the CA certificates provided by certifi, which is crucial for
@@ -16,119 +30,890 @@ os.environ['SSL_CERT_FILE'] = certifi.where() # Points to the cacert.pem file fr
 # Encryption key, must be identical on both client and server.
 # IMPORTANT: Replace with your own securely generated key.
 # You can generate a key using generate_key.py script: print(Fernet.generate_key().decode())
-ENCRYPTION_KEY = b'YOUR_ACTUAL_ENCRYPTION_KEY_HERE_FROM_GENERATE_KEY_DOT_PY' 
+# The DRIVEVPN_ENCRYPTION_KEY environment variable, if set, takes precedence (e.g. for benchmarks).
+ENCRYPTION_KEY = os.environ.get('DRIVEVPN_ENCRYPTION_KEY', '').encode() or b'YOUR_ACTUAL_ENCRYPTION_KEY_HERE_FROM_GENERATE_KEY_DOT_PY' 
 fernet = Fernet(ENCRYPTION_KEY)
 
+# Crypto envelope of tunnel files (see encrypt_data):
+#   VERSION (1 byte) | CONTEXT_LENGTH (1 byte) | CONTEXT | NONCE (12 bytes) | AES-256-GCM ciphertext + 16-byte tag
+# The key is derived with HKDF from ENCRYPTION_KEY and the context (e.g. the sender's ID),
+# so every tunnel endpoint encrypts under its own key; the context is authenticated too.
+# Unlike Fernet there is no base64 expansion: the envelope adds 30 bytes plus the context.
+ENVELOPE_VERSION = 0x01
+ENVELOPE_NONCE_SIZE = 12
+# Set to True to keep producing Fernet tokens while peers still run the old code
+# (decrypt_data accepts both formats either way)
+ENVELOPE_USE_FERNET = False
+
 # Google Drive API scopes and token file path
 SCOPES = ['https://www.googleapis.com/auth/drive'] # Full Drive access
 TOKEN_FILE = 'token.json' # File to store authenticated user's tokens
+TOKEN_REFRESH_MARGIN = 300 # Refresh the access token this many seconds before it expires
 
 # Base URLs for Google Drive API
-GOOGLE_DRIVE_API = 'https://www.googleapis.com/drive/v3'
-UPLOAD_API = 'https://www.googleapis.com/upload/drive/v3/files'
+# (can be overridden through the environment, e.g. to point the tunnel at a local fake Drive server)
+GOOGLE_DRIVE_API = os.environ.get('DRIVE_API_URL', 'https://www.googleapis.com/drive/v3')
+UPLOAD_API = os.environ.get('DRIVE_UPLOAD_API_URL', 'https://www.googleapis.com/upload/drive/v3/files')
+BATCH_API = os.environ.get('DRIVE_BATCH_API_URL', 'https://www.googleapis.com/batch/drive/v3')
+BATCH_MAX_REQUESTS = 100 # Drive accepts at most 100 calls per batch request
 
+# Listing: files per page (Drive allows up to 1000) and per-file fields requested
+LIST_PAGE_SIZE = 1000
+LIST_FILE_FIELDS = 'id, name, createdTime' # Include createdTime for sorting
 
-def get_token():
+# File storing the Drive changes feed page token of each watched folder (see ChangesWatcher)
+CHANGES_STATE_FILE = 'changes_state.json'
+# The changes feed does a full folder listing every this many calls, to pick up files
+# that were reported earlier but could not be processed at the time
+CHANGES_FULL_RESYNC_EVERY = 100
+
+# Client-side rate limit shared by all Drive API calls of this process (token bucket):
+# DRIVE_RATE_LIMIT calls per second on average, bursts of up to DRIVE_RATE_BURST calls.
+# Keeps the tunnel under the Drive per-user quota instead of running into it.
+DRIVE_RATE_LIMIT = 10
+DRIVE_RATE_BURST = 20
+
+# Priorities of the rate limiter: when calls are waiting for quota, tunnel data goes first,
+# then folder listings (discovering new data), then deletions of consumed files
+PRIORITY_DATA = 0
+PRIORITY_LIST = 1
+PRIORITY_DELETE = 2
+
+# Retries of rate-limited (403 rateLimitExceeded, 429), failed (5xx) and network-failed calls:
+# jittered exponential backoff from DRIVE_BACKOFF_BASE up to DRIVE_BACKOFF_MAX seconds,
+# or as long as the Retry-After header asks, for at most DRIVE_MAX_RETRIES retries
+DRIVE_MAX_RETRIES = 5
+DRIVE_BACKOFF_BASE = 1.0
+DRIVE_BACKOFF_MAX = 32.0
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+# Uploads of at least RESUMABLE_UPLOAD_THRESHOLD bytes use Drive's resumable protocol,
+# sent in RESUMABLE_CHUNK_SIZE pieces (a multiple of 256 KiB, as Drive requires); after a
+# failure only the part Drive has not stored yet is sent again
+RESUMABLE_UPLOAD_THRESHOLD = 5 * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = 8 * 256 * 1024
+# Bytes per chunk when downloads are streamed (see iter_download_file)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Maximum number of pooled keep-alive connections to googleapis.com.
+# Should be at least the number of Drive calls the tunnel runs concurrently
+# (i.e. the asyncio.to_thread workers of client.py / server.py; the asyncio client
+# in drive_async.py uses the same limit for its aiohttp connection pool).
+DRIVE_POOL_SIZE = 32
+
+
+class TokenCache:
     """
-    Loads Google OAuth2 credentials from token.json.
-    Refreshes the access token if it's expired using the refresh token.
-    If no valid token exists, it exits (primarily for server-side where interactive auth isn't possible).
+    Process-wide in-memory cache of the Google OAuth2 credentials from token.json.
+    The hot path (get_token) only reads the cached access token; token.json is read
+    once at startup. A single background thread refreshes the token shortly before it
+    expires and persists it atomically, so concurrent Drive calls never race to
+    refresh or rewrite the token file.
     """
-    creds = None
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-    
-    # Check if credentials are valid and if not, try to refresh them
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            try:
-                # Refresh the token using google.auth's Request object
-                creds.refresh(GoogleAuthRequest()) 
-            except Exception as e:
-                # Log error and exit if refresh fails (common on server without browser)
-                print(f"Error refreshing token: {e}. Token might be revoked or network issue.")
-                exit("Authentication token refresh failed. Please generate a new token.json on client and transfer.")
-        else:
+
+    def __init__(self, token_file=TOKEN_FILE, scopes=SCOPES, refresh_margin=None):
+        self.token_file = token_file
+        self.scopes = scopes
+        self.refresh_margin = TOKEN_REFRESH_MARGIN if refresh_margin is None else refresh_margin
+        self._creds = None
+        self._lock = threading.Lock() # Serializes loading and refreshing of the credentials
+        self._refresh_thread = None
+
+    def get_token(self):
+        """
+        Returns a valid access token, from memory whenever possible.
+        Only blocks if the token is missing or already expired, in which case
+        concurrent callers wait for a single load/refresh.
+        """
+        token = self.cached_token()
+        if token is not None:
+            return token
+
+        with self._lock:
+            if self._creds is None:
+                self._creds = self._load()
+            if self._seconds_left(self._creds) <= 0:
+                try:
+                    self._refresh()
+                except Exception as e:
+                    # Log error and exit if refresh fails (common on server without browser)
+                    print(f"Error refreshing token: {e}. Token might be revoked or network issue.")
+                    exit("Authentication token refresh failed. Please generate a new token.json on client and transfer.")
+            self._start_refresh_thread()
+            return self._creds.token
+
+    def cached_token(self):
+        """
+        Returns the access token if it is in memory and not expired, else None; never blocks.
+        """
+        creds = self._creds
+        if creds is not None and self._seconds_left(creds) > 0:
+            return creds.token
+        return None
+
+    def _load(self):
+        """
+        Loads the credentials from token.json, exiting if there is nothing usable.
+        """
+        creds = None
+        if os.path.exists(self.token_file):
+            creds = Credentials.from_authorized_user_file(self.token_file, self.scopes)
+        if not creds or (not creds.valid and not creds.refresh_token):
             # If no valid creds and no refresh token (or first run on server without token.json)
             # On the server, we expect token.json to be pre-generated by client.py
-            print(f"Error: No valid token found in {TOKEN_FILE}.")
+            print(f"Error: No valid token found in {self.token_file}.")
             exit("Authentication token not found or invalid. Please ensure token.json is correctly set up from client.")
+        return creds
+
+    @staticmethod
+    def _seconds_left(creds):
+        """
+        Seconds until the access token expires (infinite if it has no expiry).
+        """
+        if not creds.token:
+            return 0
+        if creds.expiry is None:
+            return float('inf')
+        # google-auth stores expiry as a naive UTC datetime
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (creds.expiry - now).total_seconds()
+
+    def _refresh(self):
+        """
+        Refreshes the access token and saves it. Must be called with self._lock held.
+        """
+        # Refresh the token using google.auth's Request object over the pooled session
+        self._creds.refresh(GoogleAuthRequest(session=get_transport().session))
+        self._save()
+
+    def _save(self):
+        """
+        Atomically writes the credentials to token.json (write to a temp file, then rename),
+        so a crash mid-write can never leave a truncated token file behind.
+        """
+        tmp_file = f"{self.token_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as token_file_obj:
+            token_file_obj.write(self._creds.to_json())
+        os.replace(tmp_file, self.token_file)
+
+    def _start_refresh_thread(self):
+        if self._refresh_thread is None:
+            self._refresh_thread = threading.Thread(target=self._refresh_loop, name='token-refresh', daemon=True)
+            self._refresh_thread.start()
+
+    def _refresh_loop(self):
+        """
+        Background loop that refreshes the token refresh_margin seconds before expiry.
+        On failure it retries shortly; the current token keeps being served until it expires.
+        """
+        while True:
+            wait = self._seconds_left(self._creds) - self.refresh_margin
+            if wait > 0:
+                time.sleep(min(wait, 3600))
+                continue
+            try:
+                with self._lock:
+                    if self._seconds_left(self._creds) - self.refresh_margin <= 0: # Not refreshed by a blocking caller meanwhile
+                        self._refresh()
+            except Exception as e:
+                print(f"Background token refresh failed: {e}. Retrying in 30 seconds.")
+                time.sleep(30)
+
+
+token_cache = TokenCache()
+
+
+def get_token():
+    """
+    Returns a valid OAuth2 access token from the process-wide token cache.
+    If no valid token exists, it exits (primarily for server-side where interactive auth isn't possible).
+    """
+    return token_cache.get_token()
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket shared by all Drive API calls of the process, whether made
+    from threads (acquire) or from coroutines (acquire_async). Waiting calls are served
+    by priority (lowest value first, then in arrival order), across both kinds of callers.
+    pause() holds back every call for a while, used when Drive reports that the quota
+    is exhausted. throttled_calls counts the calls that had to wait.
+    """
+
+    def __init__(self, rate=DRIVE_RATE_LIMIT, burst=DRIVE_RATE_BURST):
+        self.rate = rate # Calls per second; None or 0 disables the limit
+        self.burst = burst
+        self.throttled_calls = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = [] # Heap of (priority, ticket) of the calls waiting for a token
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+        self._async_waiters = {} # key: (priority, ticket) of a waiting coroutine, value: (its event loop, asyncio.Event waking it)
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _take(self, entry):
+        """
+        Takes a token for the waiting call entry if it is its turn. Returns 0 if it got
+        one, otherwise the seconds to wait (None: until the calls ahead have been served).
+        Must be called with self._condition held.
+        """
+        now = time.monotonic()
+        self._refill(now)
+        if self._waiting[0] != entry:
+            return None
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.rate:
+            if self._tokens < 1:
+                return (1 - self._tokens) / self.rate
+            self._tokens -= 1
+        return 0
+
+    def _leave(self, entry, waited):
+        """
+        Removes a served (or cancelled) call from the queue. Must be called with self._condition held.
+        """
+        self._waiting.remove(entry)
+        heapq.heapify(self._waiting)
+        if waited:
+            self.throttled_calls += 1
+        self._notify_all()
+
+    def _notify_all(self):
+        """
+        Wakes every waiting call, threads and coroutines, to check whether it is its turn.
+        """
+        self._condition.notify_all()
+        for loop, event in self._async_waiters.values():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass # Event loop already closed
+
+    def acquire(self, priority=PRIORITY_DATA):
+        """
+        Waits for a token; calls with a lower priority value are served first.
+        """
+        with self._condition:
+            entry = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, entry)
+            waited = False
+            try:
+                while True:
+                    timeout = self._take(entry)
+                    if timeout == 0:
+                        return
+                    waited = True
+                    self._condition.wait(timeout)
+            finally:
+                self._leave(entry, waited)
+
+    async def acquire_async(self, priority=PRIORITY_DATA):
+        """
+        acquire() for coroutines: waits on the event loop instead of blocking its thread.
+        """
+        event = asyncio.Event()
+        with self._condition:
+            entry = (priority, next(self._tickets))
+            heapq.heappush(self._waiting, entry)
+            self._async_waiters[entry] = (asyncio.get_running_loop(), event)
+        waited = False
+        try:
+            while True:
+                event.clear() # Before checking, so a wake-up sent meanwhile is not lost
+                with self._condition:
+                    timeout = self._take(entry)
+                if timeout == 0:
+                    return
+                waited = True
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                del self._async_waiters[entry]
+                self._leave(entry, waited)
+
+    def pause(self, seconds):
+        """
+        Holds back all calls for the given number of seconds (e.g. after a 429 response).
+        """
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._notify_all()
+
+
+rate_limiter = RateLimiter()
+
+
+def _is_rate_limited(response):
+    """
+    True for responses telling that the Drive quota is exhausted (429, or 403 with a rate limit reason).
+    """
+    return _is_rate_limit_status(response.status_code, lambda: response.content)
+
+
+def _is_rate_limit_status(status_code, get_body):
+    """
+    Rate limit check on a response status; get_body() returns the response body (only called for 403).
+    """
+    if status_code == 429:
+        return True
+    if status_code != 403:
+        return False
+    try:
+        errors = json.loads(get_body()).get('error', {}).get('errors', [])
+    except (ValueError, AttributeError):
+        return False
+    return any(error.get('reason') in RATE_LIMIT_REASONS for error in errors)
+
+
+def _retry_after(headers):
+    """
+    Seconds to wait according to the Retry-After response header (seconds or HTTP date), or None.
+    """
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    if value.strip().isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def _backoff_delay(attempt):
+    """
+    Jittered exponential backoff ("full jitter"): a random delay of up to base * 2^attempt seconds.
+    """
+    return random.uniform(0, min(DRIVE_BACKOFF_MAX, DRIVE_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _retry_delay(method, url, status, headers, get_body, attempt, max_retries):
+    """
+    Retry policy of every Drive API call, shared by DriveTransport.request and
+    drive_async.AsyncDriveClient.request. Counts the attempt, then returns the seconds
+    to wait before retrying it, or None if the response is final. status is None after
+    a connection error; headers and get_body (see _is_rate_limit_status) describe the
+    response otherwise. Rate-limited (403 rateLimitExceeded, 429) and 5xx responses and
+    connection errors are retried up to max_retries times with jittered exponential
+    backoff, honoring Retry-After; a rate-limited response also pauses all other calls
+    for that time.
+    """
+    api_calls_total.inc(operation=operation_of(method, url), status='error' if status is None else status)
+    rate_limited = status is not None and _is_rate_limit_status(status, get_body)
+    if status is not None and not (rate_limited or status >= 500):
+        return None
+    if attempt >= max_retries:
+        return None
+    delay = _retry_after(headers)
+    if delay is None:
+        delay = _backoff_delay(attempt)
+    if rate_limited:
+        rate_limiter.pause(delay) # The quota is shared: hold back every call, not just this one
+    print(f"Drive API {method} retry {attempt + 1}/{max_retries} in {delay:.1f}s ({status or 'connection error'})")
+    return delay
+
+
+class DriveTransport:
+    """
+    Shared HTTP transport for all Google Drive API calls.
+    Wraps a single requests.Session whose connection pool keeps TLS connections
+    to googleapis.com alive between calls, so a tunnel packet does not pay a new
+    TCP+TLS handshake per API request.
+
+    The session is configured once and never mutated afterwards (per-call headers
+    are passed explicitly), which makes it safe to share between the threads used
+    by asyncio.to_thread; urllib3's connection pool is itself thread-safe.
+    """
+
+    def __init__(self, pool_size=DRIVE_POOL_SIZE):
+        self.session = requests.Session()
+        # pool_block=True makes extra threads wait for a free connection instead of
+        # opening (and then discarding) connections beyond the pool size
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Connection': 'keep-alive'})
+
+    def request(self, method, url, priority=PRIORITY_DATA, max_retries=DRIVE_MAX_RETRIES, **kwargs):
+        """
+        Sends an authorized request to the Drive API over the pooled session.
+        Every attempt takes a token from the shared rate limiter (see RateLimiter) and
+        failed attempts are retried as _retry_delay decides. The last response is
+        returned (or the last connection error raised) when the retries are used up.
+        """
+        extra_headers = kwargs.pop('headers', None) or {}
+        attempt = 0
+        while True:
+            rate_limiter.acquire(priority)
+            headers = {"Authorization": f"Bearer {get_token()}"}
+            headers.update(extra_headers)
+            try:
+                response = self.session.request(method, url, headers=headers, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                delay = _retry_delay(method, url, None, None, None, attempt, max_retries)
+                if delay is None:
+                    raise
+            else:
+                delay = _retry_delay(method, url, response.status_code, response.headers,
+                                     lambda: response.content, attempt, max_retries)
+                if delay is None:
+                    return response
+                # Hand the connection back to the pool; a streamed response (stream=True) that is
+                # dropped unread keeps its pooled connection, and with pool_block=True it is never freed
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Returns the process-wide DriveTransport, creating it on first use.
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = DriveTransport()
+    return _transport
+
+
+class FolderIndex:
+    """
+    Thread-safe cache of file name -> file IDs per Drive folder, used by upload_file
+    to honour overwrite semantics without listing the folder before every upload.
+    A folder is known once it has been listed completely (upload_file lists it before
+    its first overwrite check); afterwards the index is kept current by this process's
+    uploads, deletions and any list_files_in_folder call.
+    Files created by another process since the last listing are not known to it.
+    """
+
+    def __init__(self):
+        self._folders = {} # key: folder_id, value: {file_name: set(file_ids)}
+        self._lock = threading.Lock()
+
+    def lookup(self, folder_id, file_name):
+        """
+        Returns the IDs of files named file_name in the folder; [] if the folder has not
+        been listed yet. Never calls Drive, so it is safe on the event loop.
+        """
+        with self._lock:
+            return list(self._folders.get(folder_id, {}).get(file_name, ()))
+
+    def __contains__(self, folder_id):
+        with self._lock:
+            return folder_id in self._folders
+
+    def replace(self, folder_id, files):
+        names = {}
+        for f in files:
+            names.setdefault(f['name'], set()).add(f['id'])
+        with self._lock:
+            self._folders[folder_id] = names
+
+    def add(self, folder_id, file_name, file_id):
+        with self._lock:
+            if folder_id in self._folders: # Unlisted folders are populated lazily on lookup
+                self._folders[folder_id].setdefault(file_name, set()).add(file_id)
+
+    def discard(self, file_id):
+        with self._lock:
+            for names in self._folders.values():
+                for file_name, file_ids in list(names.items()):
+                    if file_id in file_ids:
+                        file_ids.discard(file_id)
+                        if not file_ids:
+                            del names[file_name]
+                        return
+
+    def invalidate(self, folder_id=None):
+        """
+        Forgets the cached contents of one folder (or of all folders).
+        """
+        with self._lock:
+            if folder_id is None:
+                self._folders.clear()
+            else:
+                self._folders.pop(folder_id, None)
+
+
+folder_index = FolderIndex()
+
 
-        # Save the updated/new credentials
-        with open(TOKEN_FILE, 'w') as token_file_obj:
-            token_file_obj.write(creds.to_json())
+# --- Drive operations ---
+# Listing, uploading, downloading and deleting files are written once, as generators that
+# yield the DriveCall they need next and are sent its DriveResponse; the generator's return
+# value is the result of the operation. run_operation() runs them with blocking calls (the
+# functions below are thin wrappers around it) and drive_async.AsyncDriveClient runs the
+# same generators on the event loop, so both share results, error handling and index updates.
 
-    return creds.token
+# One Drive API request: method, URL, rate limiter priority and the keyword arguments
+# of the HTTP request (params, data, headers: understood by both requests and aiohttp)
+DriveCall = namedtuple('DriveCall', ['method', 'url', 'priority', 'options'])
+# Status, headers and fully read body of a Drive API response
+DriveResponse = namedtuple('DriveResponse', ['status', 'headers', 'body'])
 
 
-def list_files_in_folder(folder_id):
+def _text(response):
+    return response.body.decode('utf-8', errors='replace')
+
+
+def run_operation(operation):
     """
-    Lists files within a specified folder in Google Drive.
+    Runs a Drive operation generator with blocking calls over the shared transport
+    and returns its result.
     """
-    token = get_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    params = {
+    response = None
+    while True:
+        try:
+            call = operation.send(response)
+        except StopIteration as done:
+            return done.value
+        raw = get_transport().request(call.method, call.url, priority=call.priority, **call.options)
+        response = DriveResponse(raw.status_code, raw.headers, raw.content)
+
+
+def _list_params(folder_id, page_size=None, fields=None):
+    """
+    Query parameters of a folder listing; fields selects the per-file fields to request
+    (only what is needed keeps responses small).
+    """
+    return {
         "q": f"'{folder_id}' in parents and trashed=false",
-        "fields": "files(id, name, createdTime)", # Include createdTime for sorting
-        "pageSize": 100
+        "fields": f"nextPageToken, files({fields or LIST_FILE_FIELDS})",
+        "orderBy": "createdTime", # Sorted server-side, so order holds across pages
+        "pageSize": str(page_size or LIST_PAGE_SIZE)
     }
-    response = requests.get(f"{GOOGLE_DRIVE_API}/files", headers=headers, params=params)
-    if response.status_code == 200:
-        return response.json().get('files', [])
-    else:
-        print(f"List files failed (HTTP {response.status_code}): {response.text}")
-        return []
 
 
-def upload_file(file_name, content_bytes, folder_id):
+def _list_page_op(params):
+    """
+    Fetches one page of a folder listing (see _list_params; params['pageToken'] selects the page).
+    Returns (files, next page token or None), or None after printing the error if it failed.
+    """
+    response = yield DriveCall('GET', f"{GOOGLE_DRIVE_API}/files", PRIORITY_LIST, {'params': params})
+    if response.status != 200:
+        print(f"List files failed (HTTP {response.status}): {_text(response)}")
+        return None
+    body = json.loads(response.body)
+    return body.get('files', []), body.get('nextPageToken')
+
+
+def _list_files_op(folder_id, page_size=None, max_files=None):
+    """
+    Lists files within a folder, oldest first, page by page until every page was fetched
+    or max_files files were seen. Stops early if a page fails.
+    """
+    params = _list_params(folder_id, page_size)
+    files = []
+    while max_files is None or len(files) < max_files:
+        page = yield from _list_page_op(params)
+        if page is None:
+            break
+        files.extend(page[0])
+        if not page[1]:
+            # Every complete listing refreshes the name->id index for free (a partial one may not)
+            folder_index.replace(folder_id, files)
+            break
+        params['pageToken'] = page[1]
+    return files if max_files is None else files[:max_files]
+
+
+def _delete_existing_op(folder_id, file_name):
+    """
+    Deletes the files named file_name in the folder, as found in the folder index.
+    An unknown folder is listed first; if that listing fails, nothing is deleted.
+    """
+    if folder_id not in folder_index:
+        yield from _list_files_op(folder_id) # Populates the index
+    for existing_file_id in folder_index.lookup(folder_id, file_name):
+        yield from _delete_file_op(existing_file_id)
+
+
+def _upload_file_op(file_name, content_bytes, folder_id, overwrite):
+    """
+    Uploads a file in a single multipart request, after deleting the files with the
+    same name first if overwrite is set. Returns the file ID, or None on failure.
+    """
+    if overwrite:
+        yield from _delete_existing_op(folder_id, file_name)
+    # multipart/related body: the JSON metadata part, then the content part
+    boundary = f"upload_{uuid.uuid4().hex}"
+    metadata = json.dumps({'name': file_name, 'parents': [folder_id]})
+    body = b''.join([
+        f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{metadata}\r\n".encode('utf-8'),
+        f"--{boundary}\r\nContent-Type: application/octet-stream\r\n\r\n".encode('utf-8'),
+        content_bytes,
+        f"\r\n--{boundary}--\r\n".encode('utf-8'),
+    ])
+    response = yield DriveCall('POST', f"{UPLOAD_API}?uploadType=multipart", PRIORITY_DATA,
+                               {'data': body, 'headers': {'Content-Type': f'multipart/related; boundary={boundary}'}})
+    if response.status in [200, 201]:
+        file_id = json.loads(response.body)['id']
+        folder_index.add(folder_id, file_name, file_id)
+        return file_id
+    print(f"Upload failed (HTTP {response.status}): {_text(response)}")
+    return None
+
+
+def _download_file_op(file_id):
+    """
+    Downloads a file by its ID. Returns its content as bytes, or None on failure.
+    """
+    response = yield DriveCall('GET', f"{GOOGLE_DRIVE_API}/files/{file_id}?alt=media", PRIORITY_DATA, {})
+    if response.status == 200:
+        return response.body
+    print(f"Download failed (HTTP {response.status}): {_text(response)}")
+    return None
+
+
+def _delete_file_op(file_id):
+    """
+    Deletes a file by its ID. Returns True if it was deleted or already gone (404).
+    """
+    response = yield DriveCall('DELETE', f"{GOOGLE_DRIVE_API}/files/{file_id}", PRIORITY_DELETE, {})
+    if response.status in [204, 200]: # 204 No Content is standard for successful DELETE
+        folder_index.discard(file_id)
+        return True
+    elif response.status == 404: # File already not found, consider it deleted
+        print(f"Delete warning: File {file_id} not found (already deleted?).")
+        folder_index.discard(file_id)
+        return True
+    print(f"Delete failed (HTTP {response.status}): {_text(response)}")
+    return False
+
+
+def _delete_files_batch_op(file_ids):
+    """
+    Deletes many files with batch requests (up to BATCH_MAX_REQUESTS deletions each).
+    Returns a dict mapping each file ID to True if it was deleted or already gone.
+    """
+    results = {}
+    file_ids = list(file_ids)
+    for start in range(0, len(file_ids), BATCH_MAX_REQUESTS):
+        chunk = file_ids[start : start + BATCH_MAX_REQUESTS]
+        boundary, body = _batch_delete_body(chunk)
+        response = yield DriveCall('POST', BATCH_API, PRIORITY_DELETE,
+                                   {'data': body, 'headers': {'Content-Type': f'multipart/mixed; boundary={boundary}'}})
+        if response.status != 200:
+            print(f"Batch delete failed (HTTP {response.status}): {_text(response)}")
+            results.update((file_id, False) for file_id in chunk)
+            continue
+        statuses = _parse_batch_statuses(response.headers.get('Content-Type', ''), _text(response))
+        for index, file_id in enumerate(chunk):
+            deleted = statuses.get(index) in (200, 204, 404)
+            if deleted:
+                folder_index.discard(file_id)
+            results[file_id] = deleted
+    return results
+
+
+def iter_files_in_folder(folder_id, page_size=None, fields=None):
+    """
+    Lists files within a specified folder in Google Drive, oldest first, yielding
+    them page by page so every file is seen even when the folder holds more than
+    one page. fields selects the per-file fields to request (see _list_params).
+    Stops early, after printing the error, if a page fails; the generator's return
+    value tells whether the listing was complete.
+    """
+    params = _list_params(folder_id, page_size, fields)
+    while True:
+        page = run_operation(_list_page_op(params))
+        if page is None:
+            return False
+        yield from page[0]
+        if not page[1]:
+            return True
+        params['pageToken'] = page[1]
+
+
+def list_files_in_folder(folder_id, page_size=None, max_files=None):
+    """
+    Lists files within a specified folder in Google Drive (all pages), oldest first.
+    max_files caps the result, letting a poll loop drain a large backlog in bulk
+    batches instead of fetching every page before processing anything.
+    """
+    files = []
+    pages = iter_files_in_folder(folder_id, page_size)
+    while max_files is None or len(files) < max_files:
+        try:
+            files.append(next(pages))
+        except StopIteration as end:
+            if end.value: # Only a complete listing may refresh the name->id index
+                folder_index.replace(folder_id, files) # Every listing refreshes the name->id index for free
+            break
+    return files
+
+
+def upload_file(file_name, content_bytes, folder_id, overwrite=True):
     """
     Uploads a file with specified byte content to a specific folder in Google Drive.
-    If a file with the same name exists, it will be deleted first for simplicity.
+    If overwrite is True, a file with the same name is deleted first for simplicity;
+    existing names are looked up in the cached folder index, so only the first upload
+    to a folder costs an extra listing.
+    Callers whose file names are unique (e.g. tunnel packets) should pass overwrite=False,
+    which skips the existence check and makes the upload a single API call.
+    Files of RESUMABLE_UPLOAD_THRESHOLD bytes or more are sent with upload_file_resumable.
     """
-    token = get_token()
-    headers = {"Authorization": f"Bearer {token}"}
+    if len(content_bytes) >= RESUMABLE_UPLOAD_THRESHOLD:
+        if overwrite:
+            run_operation(_delete_existing_op(folder_id, file_name))
+        return upload_file_resumable(file_name, content_bytes, folder_id)
+    return run_operation(_upload_file_op(file_name, content_bytes, folder_id, overwrite))
 
-    # Delete existing file with the same name in the target folder to avoid conflicts
-    existing_files = list_files_in_folder(folder_id)
-    for f in existing_files:
-        if f['name'] == file_name:
-            delete_file(f['id']) # Use the delete_file function
 
-    # Metadata for the new file
-    metadata = {
-        'name': file_name,
-        'parents': [folder_id]
-    }
-    
-    # Prepare files dictionary for multipart/form-data upload using requests
-    # 'metadata' and 'file' are the names of the multipart parts
-    files_data = {
-        'metadata': (None, json.dumps(metadata), 'application/json; charset=UTF-8'),
-        'file': (file_name, content_bytes, 'application/octet-stream') # filename, content, content_type
-    }
+class _MemoryviewReader:
+    """
+    File-like view of a byte range that requests can stream as a request body:
+    read() returns slices of the underlying buffer, so nothing is copied.
+    """
+
+    def __init__(self, view):
+        self._view = view
+        self._offset = 0
+
+    def __len__(self):
+        return len(self._view) - self._offset # requests sends this as Content-Length
+
+    def read(self, size=-1):
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._offset + size)
+        chunk = self._view[self._offset : end]
+        self._offset = end
+        return chunk
 
-    # Perform the multipart upload
-    response = requests.post(f"{UPLOAD_API}?uploadType=multipart", headers=headers, files=files_data)
-    
-    if response.status_code in [200, 201]:
-        return response.json()['id']
-    else:
-        print(f"Upload failed (HTTP {response.status_code}): {response.text}")
+
+def _resumable_offset(response):
+    """
+    Number of bytes Drive has stored, from the Range header of a 308 response.
+    """
+    committed = response.headers.get('Range') # e.g. 'bytes=0-262143'; absent if nothing was stored
+    if not committed:
+        return 0
+    return int(committed.rsplit('-', 1)[1]) + 1
+
+
+def upload_file_resumable(file_name, content_bytes, folder_id, chunk_size=None):
+    """
+    Uploads a file with Drive's resumable protocol: the upload session is created first,
+    then the content is sent in chunk_size pieces straight from content_bytes (any buffer,
+    e.g. bytes, bytearray or memoryview; nothing is copied). After a failed chunk the
+    number of bytes Drive has stored is queried and the upload continues from there,
+    up to DRIVE_MAX_RETRIES consecutive failures. Returns the file ID, or None on failure.
+    """
+    view = memoryview(content_bytes).cast('B')
+    total = len(view)
+    chunk_size = chunk_size or RESUMABLE_CHUNK_SIZE
+    metadata = {'name': file_name, 'parents': [folder_id]}
+    response = get_transport().post(f"{UPLOAD_API}?uploadType=resumable", json=metadata,
+                                    headers={'X-Upload-Content-Type': 'application/octet-stream',
+                                             'X-Upload-Content-Length': str(total)})
+    if response.status_code != 200 or 'Location' not in response.headers:
+        print(f"Resumable upload start failed (HTTP {response.status_code}): {response.text}")
         return None
+    session_url = response.headers['Location']
+
+    offset = 0
+    failures = 0
+    while True:
+        if offset < total:
+            end = min(total, offset + chunk_size)
+            content_range = f"bytes {offset}-{end - 1}/{total}"
+            body = _MemoryviewReader(view[offset:end])
+        else:
+            content_range = f"bytes */{total}" # Everything sent: ask for the result
+            body = b''
+        try:
+            # Failed chunks are not resent blindly: the loop below asks Drive what it stored
+            response = get_transport().put(session_url, data=body, headers={'Content-Range': content_range}, max_retries=0)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            response = None
+            error = str(e)
+        if response is not None:
+            if response.status_code in [200, 201]:
+                file_id = response.json()['id']
+                folder_index.add(folder_id, file_name, file_id)
+                return file_id
+            if response.status_code == 308: # Chunk stored, continue after the last stored byte
+                offset = _resumable_offset(response)
+                failures = 0
+                continue
+            if response.status_code == 404: # Upload session expired
+                print(f"Resumable upload failed: session expired after {offset} of {total} bytes")
+                return None
+            if response.status_code < 500 and not _is_rate_limited(response):
+                print(f"Resumable upload failed (HTTP {response.status_code}): {response.text}")
+                return None
+            error = f"HTTP {response.status_code}"
+
+        failures += 1
+        if failures > DRIVE_MAX_RETRIES:
+            print(f"Resumable upload failed after {DRIVE_MAX_RETRIES} retries ({error})")
+            return None
+        delay = _retry_after(response.headers if response is not None else None)
+        time.sleep(_backoff_delay(failures - 1) if delay is None else delay)
+        # Ask how much Drive has stored (Content-Range bytes */total) and resume from there
+        status_response = None
+        try:
+            status_response = get_transport().put(session_url, data=b'', headers={'Content-Range': f"bytes */{total}"})
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            pass
+        if status_response is not None and status_response.status_code == 308:
+            offset = _resumable_offset(status_response)
+        elif status_response is not None and status_response.status_code in [200, 201]:
+            offset = total # Complete after all; the next request returns the file
+
+
+def iter_download_file(file_id, chunk_size=None):
+    """
+    Downloads a file from Google Drive by its ID as a stream, yielding chunk_size pieces
+    as they arrive, so the consumer can process (or store) the content without holding
+    a second copy. The generator's return value tells whether the download was complete.
+    """
+    response = get_transport().get(f"{GOOGLE_DRIVE_API}/files/{file_id}?alt=media", stream=True)
+    with response:
+        if response.status_code != 200:
+            print(f"Download failed (HTTP {response.status_code}): {response.text}")
+            return False
+        try:
+            yield from response.iter_content(chunk_size or DOWNLOAD_CHUNK_SIZE)
+        except requests.exceptions.RequestException as e:
+            print(f"Download of {file_id} interrupted: {e}")
+            return False
+    return True
 
 
 def download_file(file_id):
     """
-    Downloads a file from Google Drive by its ID and returns its content as bytes.
+    Downloads a file from Google Drive by its ID and returns its content as bytes, or None.
+    Use iter_download_file to process large files as they arrive.
     """
-    token = get_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(f"{GOOGLE_DRIVE_API}/files/{file_id}?alt=media", headers=headers)
-    if response.status_code == 200:
-        return response.content
-    else:
-        print(f"Download failed (HTTP {response.status_code}): {response.text}")
-        return None
+    return run_operation(_download_file_op(file_id))
 
 
 def delete_file(file_id):
@@ -136,33 +921,225 @@ def delete_file(file_id):
     Deletes a file from Google Drive by its ID.
     Returns True on successful deletion or if the file was already not found (404).
     """
-    token = get_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    response = requests.delete(f"{GOOGLE_DRIVE_API}/files/{file_id}", headers=headers)
-    if response.status_code in [204, 200]: # 204 No Content is standard for successful DELETE
-        return True
-    elif response.status_code == 404: # File already not found, consider it deleted
-        print(f"Delete warning: File {file_id} not found (already deleted?).")
-        return True
-    else:
-        print(f"Delete failed (HTTP {response.status_code}): {response.text}")
-        return False
+    return run_operation(_delete_file_op(file_id))
+
+
+def delete_files_batch(file_ids):
+    """
+    Deletes many files with Drive batch requests (up to BATCH_MAX_REQUESTS deletions
+    per HTTP round trip). Returns a dict mapping each file ID to True if it was deleted
+    or already gone (404), False otherwise.
+    """
+    return run_operation(_delete_files_batch_op(file_ids))
+
+
+def _batch_delete_body(file_ids):
+    """
+    Builds the multipart/mixed body of a batch request deleting the given files.
+    Returns (boundary, body bytes); part i carries Content-ID <item{i}>.
+    """
+    boundary = f"batch_{uuid.uuid4().hex}"
+    parts = []
+    for index, file_id in enumerate(file_ids):
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <item{index}>\r\n\r\n"
+            f"DELETE /drive/v3/files/{file_id} HTTP/1.1\r\n\r\n"
+        )
+    return boundary, (''.join(parts) + f"--{boundary}--\r\n").encode('utf-8')
+
+
+def _parse_batch_statuses(content_type, body_text):
+    """
+    Extracts the HTTP status of each part of a multipart/mixed batch response
+    (given its Content-Type header and body).
+    Returns a dict mapping the part index (from its Content-ID) to the status code.
+    """
+    boundary = content_type.split('boundary=')[-1].strip('"') if 'boundary=' in content_type else None
+    if not boundary:
+        return {}
+    statuses = {}
+    for position, part in enumerate(body_text.split(f"--{boundary}")[1:]):
+        if part.startswith('--'):
+            break # Closing delimiter
+        index = position
+        status = None
+        for line in part.splitlines():
+            if line.lower().startswith('content-id:') and '<' in line:
+                content_id = line.split('<', 1)[1].rstrip('>').strip()
+                digits = content_id.rsplit('item', 1)[-1]
+                if digits.isdigit():
+                    index = int(digits)
+            elif line.startswith('HTTP/'):
+                status = int(line.split()[1])
+                break
+        statuses[index] = status
+    return statuses
+
+
+class ChangesWatcher:
+    """
+    Discovers new files in a folder through the Drive changes feed instead of listing
+    the whole folder on every poll. A start page token is kept per folder and persisted
+    in CHANGES_STATE_FILE, so each call only returns files created (and not yet deleted)
+    since the previous call, and a restarted process resumes where it left off.
+
+    list_new_files() returns the same file dicts (id, name, createdTime) as
+    list_files_in_folder, so a poll loop can use either one.
+    """
+
+    _state_lock = threading.Lock() # Serializes read-modify-write of the shared state file
+
+    def __init__(self, folder_id, state_file=None, full_resync_every=None):
+        self.folder_id = folder_id
+        self.state_file = state_file or CHANGES_STATE_FILE
+        self.full_resync_every = CHANGES_FULL_RESYNC_EVERY if full_resync_every is None else full_resync_every
+        self.page_token = self._load_page_token()
+        self._calls = 0
+
+    def _load_page_token(self):
+        with self._state_lock:
+            if not os.path.exists(self.state_file):
+                return None
+            try:
+                with open(self.state_file) as state_file_obj:
+                    return json.load(state_file_obj).get(self.folder_id)
+            except (OSError, ValueError) as e:
+                print(f"Could not read changes state from {self.state_file}: {e}")
+                return None
+
+    def _save_page_token(self):
+        with self._state_lock:
+            state = {}
+            if os.path.exists(self.state_file):
+                try:
+                    with open(self.state_file) as state_file_obj:
+                        state = json.load(state_file_obj)
+                except (OSError, ValueError):
+                    state = {}
+            state[self.folder_id] = self.page_token
+            tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w') as state_file_obj:
+                json.dump(state, state_file_obj)
+            os.replace(tmp_file, self.state_file)
+
+    def _fetch_start_page_token(self):
+        response = get_transport().get(f"{GOOGLE_DRIVE_API}/changes/startPageToken", priority=PRIORITY_LIST)
+        if response.status_code == 200:
+            return response.json()['startPageToken']
+        print(f"Get start page token failed (HTTP {response.status_code}): {response.text}")
+        return None
+
+    def list_new_files(self):
+        """
+        Returns the files created in the folder since the previous call, oldest first.
+        The first call (and every full_resync_every-th call) lists the whole folder.
+        """
+        self._calls += 1
+        if self.page_token is None or (self.full_resync_every and self._calls % self.full_resync_every == 0):
+            if self.page_token is None:
+                # Take the token before listing, so nothing created in between is missed
+                self.page_token = self._fetch_start_page_token()
+                if self.page_token is not None:
+                    self._save_page_token()
+            return list_files_in_folder(self.folder_id)
+
+        new_files = {} # key: file id, value: file dict (dict keeps first-seen order)
+        page_token = self.page_token
+        while page_token:
+            params = {
+                "pageToken": page_token,
+                "pageSize": 1000,
+                "spaces": "drive",
+                "fields": "nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, createdTime, parents, trashed))"
+            }
+            response = get_transport().get(f"{GOOGLE_DRIVE_API}/changes", params=params, priority=PRIORITY_LIST)
+            if response.status_code != 200:
+                print(f"List changes failed (HTTP {response.status_code}): {response.text}")
+                break # Keep the last saved token; the next call retries from there
+            body = response.json()
+            for change in body.get('changes', []):
+                file_info = change.get('file')
+                if change.get('removed') or not file_info or file_info.get('trashed'):
+                    new_files.pop(change.get('fileId'), None)
+                elif self.folder_id in file_info.get('parents', []):
+                    new_files[file_info['id']] = {
+                        'id': file_info['id'],
+                        'name': file_info['name'],
+                        'createdTime': file_info.get('createdTime', ''),
+                    }
+            if 'newStartPageToken' in body:
+                # Last page: remember where the next call starts
+                self.page_token = body['newStartPageToken']
+                self._save_page_token()
+                break
+            page_token = body.get('nextPageToken')
+
+        files = list(new_files.values())
+        files.sort(key=lambda x: x['createdTime'])
+        return files
+
+
+_changes_watchers = {}
+_changes_watchers_lock = threading.Lock()
+
+
+def list_new_files(folder_id):
+    """
+    Returns the files created in a folder since the previous call, using the Drive
+    changes feed (one ChangesWatcher per folder). A drop-in alternative to
+    list_files_in_folder for poll loops that consume every file they are given.
+    """
+    with _changes_watchers_lock:
+        watcher = _changes_watchers.get(folder_id)
+        if watcher is None:
+            watcher = _changes_watchers[folder_id] = ChangesWatcher(folder_id)
+    return watcher.list_new_files()
+
+
+_envelope_ciphers = {} # key: context bytes, value: AESGCM with the key derived for it
+
+
+def _envelope_cipher(context):
+    """
+    Returns the AES-GCM cipher for a context, deriving its key from ENCRYPTION_KEY on first use.
+    """
+    cipher = _envelope_ciphers.get(context)
+    if cipher is None:
+        master_key = base64.urlsafe_b64decode(ENCRYPTION_KEY)
+        key = HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                   info=b'drivevpn-envelope-v1:' + context).derive(master_key)
+        cipher = _envelope_ciphers[context] = AESGCM(key)
+    return cipher
 
 
-def encrypt_data(data_bytes):
+def encrypt_data(data_bytes, context=b''):
     """
-    Encrypts given byte data using Fernet symmetric encryption.
+    Encrypts given byte data into a binary AES-GCM envelope (see ENVELOPE_VERSION).
+    context (at most 255 bytes, e.g. the sender's ID) selects the derived key.
     """
-    return fernet.encrypt(data_bytes)
+    if ENVELOPE_USE_FERNET:
+        return fernet.encrypt(data_bytes)
+    nonce = os.urandom(ENVELOPE_NONCE_SIZE)
+    header = bytes([ENVELOPE_VERSION, len(context)]) + context
+    return header + nonce + _envelope_cipher(context).encrypt(nonce, data_bytes, header)
 
 
 def decrypt_data(encrypted_data_bytes):
     """
-    Decrypts given encrypted byte data using Fernet symmetric encryption.
-    Handles potential decryption errors (e.g., corrupted data, wrong key).
+    Decrypts given encrypted byte data: an AES-GCM envelope, or a Fernet token from
+    peers running an older version. Handles potential decryption errors
+    (e.g., corrupted data, wrong key) by returning None.
     """
     try:
-        return fernet.decrypt(encrypted_data_bytes)
+        if encrypted_data_bytes[:1] == bytes([ENVELOPE_VERSION]):
+            context_end = 2 + encrypted_data_bytes[1]
+            header = encrypted_data_bytes[:context_end]
+            nonce = encrypted_data_bytes[context_end : context_end + ENVELOPE_NONCE_SIZE]
+            ciphertext = encrypted_data_bytes[context_end + ENVELOPE_NONCE_SIZE:]
+            return _envelope_cipher(bytes(header[2:])).decrypt(nonce, ciphertext, header)
+        return fernet.decrypt(encrypted_data_bytes) # Fernet tokens start with b'gAAAAA'
     except Exception as e:
-        print(f"Decryption error: {e}")
+        print(f"Decryption error: {e!r}")
         return None
\ No newline at end of file
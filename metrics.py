@@ -0,0 +1,330 @@
+import asyncio
+import datetime
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Metrics ---
+# Small Prometheus-style metrics registry shared by client.py, server.py and the Drive
+# modules (no extra dependency). Metrics are updated in memory (thread-safe, as the
+# blocking Drive calls run in worker threads) and rendered in the Prometheus text
+# exposition format by the local HTTP endpoint (start_metrics_server) or written to a
+# file by the opt-in periodic dump (dump_metrics_periodically).
+#
+# Pipeline stages timed in drivevpn_stage_seconds{stage=...}:
+#   socks_read        - coalescing of data read from a SOCKS5 client (first byte to packet)
+#   encrypt / decrypt - crypto envelope of a bundle
+#   upload / download - storage API call moving a bundle
+#   list_lag          - age of a bundle (since its creation) when a poll first lists it
+#   delete            - batch deletion of consumed bundles
+#   upstream_connect  - server connection to a destination
+#   upstream_read     - server wait for data from a destination
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {} # key: tuple of label values
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        """
+        Drops one label combination (e.g. of a finished session).
+        """
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self._samples():
+            lines.append(f"{name}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value per label combination.
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """
+    Value that can go up and down per label combination. set_function() makes the
+    gauge read its value from a callback when rendered.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function):
+        self._function = function # No labels: function() returns the value
+
+    def value(self, **labels):
+        if self._function is not None:
+            return self._function()
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        if self._function is not None:
+            return [(self.name, (), (), self._function())]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (cumulative buckets, sum and count) per label combination.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager observing the duration of its block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self, **labels):
+        """
+        Returns {'count', 'sum', 'buckets': [(upper bound, cumulative count)]} for one label combination.
+        """
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return {'count': 0, 'sum': 0.0, 'buckets': [(bound, 0) for bound in self.buckets]}
+            cumulative, total = [], 0
+            for bound, count in zip(self.buckets, state['counts']):
+                total += count
+                cumulative.append((bound, total))
+            return {'count': state['count'], 'sum': state['sum'], 'buckets': cumulative}
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, dict(state, counts=list(state['counts']))) for key, state in self._values.items()]
+        for key, state in items:
+            total = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                total += count
+                samples.append((f"{self.name}_bucket", key, (('le', _format_value(float(bound))),), total))
+            samples.append((f"{self.name}_bucket", key, (('le', '+Inf'),), state['count']))
+            samples.append((f"{self.name}_sum", key, (), state['sum']))
+            samples.append((f"{self.name}_count", key, (), state['count']))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Holds all metrics of the process and renders them in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing # Modules imported together (client and server) share metrics
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+stage_seconds = registry.histogram('drivevpn_stage_seconds', "Duration of tunnel pipeline stages", ['stage'])
+api_calls_total = registry.counter('drivevpn_api_calls_total', "Drive API calls by operation and HTTP status", ['operation', 'status'])
+session_bytes_total = registry.counter('drivevpn_session_bytes_total',
+                                       "Payload bytes per session; out: towards Drive, in: from Drive", ['session', 'direction'])
+active_sessions = registry.gauge('drivevpn_active_sessions', "Open tunnel sessions", ['side'])
+poll_interval_seconds = registry.gauge('drivevpn_poll_interval_seconds', "Current interval of a folder poll loop", ['folder'])
+upstream_connections_total = registry.counter('drivevpn_upstream_connections_total',
+                                              "Server connections to destinations; source: warm (pre-connected) or new", ['source'])
+compression_ratio = registry.gauge('drivevpn_compression_ratio', "Compressed / original payload bytes")
+
+
+def time_stage(stage):
+    """
+    Context manager timing one pipeline stage: `with time_stage('encrypt'): ...`
+    """
+    return stage_seconds.time(stage=stage)
+
+
+def observe_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+
+
+def observe_list_lag(created_time):
+    """
+    Records how long ago a file was created (RFC 3339 createdTime) when a poll first saw it.
+    """
+    if not created_time:
+        return
+    try:
+        created = datetime.datetime.fromisoformat(created_time.replace('Z', '+00:00'))
+    except ValueError:
+        return
+    lag = (datetime.datetime.now(datetime.timezone.utc) - created).total_seconds()
+    stage_seconds.observe(max(0.0, lag), stage='list_lag')
+
+
+def operation_of(method, url):
+    """
+    Names the Drive API operation of a request (for api_calls_total).
+    """
+    if '/batch' in url:
+        return 'batch'
+    if '/upload/' in url or 'uploadType=' in url:
+        return 'upload'
+    if '/changes' in url:
+        return 'changes'
+    if method == 'DELETE':
+        return 'delete'
+    if 'alt=media' in url:
+        return 'download'
+    if method == 'GET' and url.rstrip('/').endswith('/files'):
+        return 'list'
+    return method.lower()
+
+
+async def _handle_metrics_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass # Skip the request headers
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] in (b'/', b'/metrics'):
+            status, body = b'200 OK', registry.render().encode('utf-8')
+        else:
+            status, body = b'404 Not Found', b'Not found\n'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port):
+    """
+    Serves the metrics at http://host:port/metrics (keep host local, e.g. 127.0.0.1).
+    Returns the asyncio server, or None if it could not be started (e.g. the port is
+    taken): metrics are optional and must never keep the tunnel from starting.
+    """
+    try:
+        server = await asyncio.start_server(_handle_metrics_request, host, port)
+    except OSError as e:
+        logging.warning(f"Metrics endpoint not started on {host}:{port}: {e}")
+        return None
+    logging.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
+
+
+def dump_metrics(path):
+    """
+    Writes the current metrics in the text format to path.
+    """
+    with open(path, 'w') as f:
+        f.write(registry.render())
+
+
+async def dump_metrics_periodically(path, interval):
+    """
+    Opt-in text dump: rewrites path with the current metrics every interval seconds.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(dump_metrics, path)
+        except OSError as e:
+            logging.error(f"Metrics dump to {path} failed: {e}")
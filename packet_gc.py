@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+import logging
+from collections import deque
+
+from drive_utils_requests import BATCH_MAX_REQUESTS
+from metrics import time_stage
+from tunnel_logging import debug_tracebacks
+
+
+class PacketCollector:
+    """
+    Background garbage collector for consumed packet files.
+
+    The data path only calls discard(file_id), which queues the file and returns
+    immediately; the collector task deletes queued files in bulk with batch
+    requests of the storage backend (see storage_backends.py), re-queues failed
+    deletions (up to max_retries attempts) and, every sweep_interval seconds, deletes orphaned files older than orphan_max_age from
+    the folders it sweeps (e.g. bundles of dead sessions the peer never consumed).
+
+    Poll loops should skip files for which is_collected(file_id) is True, since a
+    queued file can still show up in a listing until the collector has deleted it.
+    """
+
+    def __init__(self, storage, batch_size=BATCH_MAX_REQUESTS, flush_interval=1.0, max_retries=5,
+                 sweep_folders=(), sweep_interval=300, orphan_max_age=900):
+        self.storage = storage # StorageBackend holding the packet files
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.sweep_folders = list(sweep_folders)
+        self.sweep_interval = sweep_interval
+        self.orphan_max_age = orphan_max_age
+        self._queue = deque() # (file_id, attempts)
+        self._pending = set() # IDs queued or being deleted
+        self._deleted = set() # Recently deleted IDs (listings may still show them for a moment)
+        self._deleted_order = deque(maxlen=10000)
+        self._wakeup = None # asyncio.Event, created lazily inside the running loop
+
+    def discard(self, file_id):
+        """
+        Queues a consumed file for deletion. Never blocks and never calls the API.
+        """
+        if file_id in self._pending or file_id in self._deleted:
+            return
+        self._pending.add(file_id)
+        self._queue.append((file_id, 0))
+        if self._wakeup is not None and len(self._queue) >= self.batch_size:
+            self._wakeup.set()
+
+    def is_collected(self, file_id):
+        """
+        True if the file was already consumed (queued for deletion or recently deleted).
+        """
+        return file_id in self._pending or file_id in self._deleted
+
+    @property
+    def pending_count(self):
+        """
+        Number of consumed files queued or being deleted (they can still show up in listings).
+        """
+        return len(self._pending)
+
+    def _mark_deleted(self, file_id):
+        self._pending.discard(file_id)
+        if len(self._deleted_order) == self._deleted_order.maxlen:
+            self._deleted.discard(self._deleted_order[0])
+        self._deleted_order.append(file_id)
+        self._deleted.add(file_id)
+
+    async def flush(self):
+        """
+        Deletes up to batch_size queued files with one batch request.
+        """
+        batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+        if not batch:
+            return
+        attempts = dict(batch)
+        try:
+            with time_stage('delete'):
+                results = await self.storage.delete_batch(list(attempts))
+        except Exception as e:
+            logging.error(f"GC: Batch delete of {len(batch)} files failed: {e}")
+            results = {}
+        for file_id, attempt in attempts.items():
+            if results.get(file_id):
+                self._mark_deleted(file_id)
+            elif attempt + 1 < self.max_retries:
+                self._queue.append((file_id, attempt + 1)) # Retry with the next batch
+            else:
+                logging.error(f"GC: Giving up deleting {file_id} after {self.max_retries} attempts")
+                self._pending.discard(file_id) # The orphan sweep will pick it up later
+
+    async def sweep_orphans(self):
+        """
+        Deletes files older than orphan_max_age from the swept folders.
+        """
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=self.orphan_max_age)
+        for folder_id in self.sweep_folders:
+            files = await self.storage.list_files(folder_id)
+            for file_info in files:
+                created = file_info.get('createdTime')
+                if not created:
+                    continue
+                if datetime.datetime.fromisoformat(created.replace('Z', '+00:00')) < cutoff:
+                    logging.info(f"GC: Deleting orphaned file {file_info['name']} from folder {folder_id}")
+                    self.discard(file_info['id'])
+
+    async def run(self):
+        """
+        Collector loop; run it as a background task.
+        """
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        next_sweep = loop.time() + self.sweep_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                while self._queue:
+                    await self.flush()
+                    if len(self._queue) < self.batch_size:
+                        break # Remaining (or retried) files go with the next tick
+                if self.sweep_folders and loop.time() >= next_sweep:
+                    next_sweep = loop.time() + self.sweep_interval
+                    await self.sweep_orphans()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"GC: Unexpected error: {e}", exc_info=debug_tracebacks())
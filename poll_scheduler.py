@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+
+class AdaptivePoller:
+    """
+    Decides how long a Drive poll loop sleeps between listings.
+
+    While traffic is moving the loop polls every min_interval seconds (burst mode,
+    kept up for burst_duration seconds after the last activity). Once the tunnel
+    goes idle the interval grows by backoff_factor per empty poll, up to
+    max_interval, which keeps idle API usage low. The current interval is exposed
+    as the current_interval attribute so it can be reported as a metric.
+    """
+
+    def __init__(self, min_interval=0.15, max_interval=5.0, backoff_factor=2.0, burst_duration=2.0):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.burst_duration = burst_duration
+        self.current_interval = min_interval
+        self._burst_until = 0.0
+        self._wakeup = None # asyncio.Event, created lazily inside the running loop
+
+    def record_poll(self, activity):
+        """
+        Updates the interval after a poll. activity is True if the poll found data.
+        """
+        now = time.monotonic()
+        if activity:
+            self._burst_until = now + self.burst_duration
+            self.current_interval = self.min_interval
+        elif now < self._burst_until:
+            self.current_interval = self.min_interval
+        else:
+            self.current_interval = min(self.max_interval, self.current_interval * self.backoff_factor)
+
+    def notify_activity(self):
+        """
+        Signals activity seen outside the poll loop (e.g. a request was just sent, so a
+        response is expected soon): switches to burst mode and cuts a running sleep short.
+        """
+        self._burst_until = time.monotonic() + self.burst_duration
+        self.current_interval = self.min_interval
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def sleep(self):
+        """
+        Sleeps for the current interval, or less if notify_activity() is called meanwhile.
+        """
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.clear()
+        interval = self.current_interval
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        else:
+            # Woken up early: wait the short burst interval so the other side has a moment to respond
+            await asyncio.sleep(min(self.min_interval, interval))
@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+
+from bundle_format import Frame, FRAME_ACK
+from tunnel_logging import sampler, debug_tracebacks
+
+# --- Reliable Transport over the Drive File Channel ---
+# Frames of one session and direction carry consecutive sequence numbers (SEQ, starting
+# at 1). Every frame sent in the opposite direction piggybacks a cumulative
+# acknowledgement (ACK = highest SEQ received in order); when there is nothing to send
+# back, a standalone ACK frame (SEQ 0) is sent after a short delay instead.
+# The sender keeps at most `window` unacknowledged frames in flight and retransmits a
+# frame when it is not acknowledged within the retransmission timeout (RTO), which is
+# derived from measured round trips (Jacobson/Karels, with Karn's rule and exponential
+# backoff). The receiver drops duplicates and delivers frames strictly in order.
+
+DEFAULT_WINDOW = 64 # Frames in flight per session and direction
+DEFAULT_INITIAL_RTO = 10.0 # Seconds; Drive round trips (upload, poll, download) are slow
+MIN_RTO = 2.0
+MAX_RTO = 60.0
+DEFAULT_ACK_DELAY = 0.5 # Seconds to wait for outgoing data to piggyback an ACK on
+DEFAULT_MAX_RETRANSMITS = 8
+
+
+class ReliableChannel:
+    """
+    Reliability layer for one session endpoint (used by both client.py and server.py).
+
+    send() assigns sequence numbers, waits while the window is full and emits frames
+    through emit_frame (e.g. a BundleBatcher's add). on_frame() takes every frame
+    received for the session, processes its acknowledgement and returns the frames
+    that are now deliverable, in order. tick() must be called periodically (see
+    service_channels) to retransmit overdue frames and flush delayed ACKs.
+    """
+
+    def __init__(self, session_id, emit_frame, window=DEFAULT_WINDOW, initial_rto=DEFAULT_INITIAL_RTO,
+                 ack_delay=DEFAULT_ACK_DELAY, max_retransmits=DEFAULT_MAX_RETRANSMITS):
+        self.session_id = session_id
+        self.emit_frame = emit_frame # async def emit_frame(frame)
+        self.window = window
+        self.ack_delay = ack_delay
+        self.max_retransmits = max_retransmits
+
+        # Sending half
+        self.next_send_seq = 1
+        self.unacked = {} # key: seq, value: {'frame_type', 'payload', 'codec', 'sent_at', 'retransmits'}
+        self.rto = initial_rto
+        self.srtt = None
+        self.rttvar = None
+        self.retransmissions = 0 # Total retransmitted frames, for diagnostics
+        self.failed = False # Set when a frame exhausted its retransmissions
+        self._window_open = asyncio.Event()
+        self._window_open.set()
+
+        # Receiving half
+        self.next_recv_seq = 1
+        self.reorder_buffer = {} # key: seq, value: Frame received ahead of a gap
+        self._ack_due_since = None # When an acknowledgement became due (None: nothing to ack)
+
+    @property
+    def ack(self):
+        """
+        Cumulative acknowledgement: the highest sequence number received in order.
+        """
+        return self.next_recv_seq - 1
+
+    @property
+    def idle(self):
+        """
+        True when nothing is in flight and no acknowledgement is owed. Frames buffered
+        behind a gap do not count: if the peer is gone, the gap is never filled.
+        """
+        return not self.unacked and self._ack_due_since is None
+
+    async def send(self, frame_type, payload=b'', codec=0, wait_for_window=True):
+        """
+        Sends a frame reliably, waiting while the window is full. Returns its sequence number.
+        codec is the compression codec of the payload (see compression.py). With
+        wait_for_window=False the frame goes out even beyond a full window (for small
+        control frames such as CLOSE that must not wait for a peer that may be gone).
+        """
+        while wait_for_window and len(self.unacked) >= self.window:
+            self._window_open.clear()
+            await self._window_open.wait()
+        seq = self.next_send_seq
+        self.next_send_seq += 1
+        self.unacked[seq] = {'frame_type': frame_type, 'payload': payload, 'codec': codec,
+                             'sent_at': time.monotonic(), 'retransmits': 0}
+        await self._emit(frame_type, seq, payload, codec)
+        return seq
+
+    async def _emit(self, frame_type, seq, payload, codec=0):
+        # Every outgoing frame piggybacks the current cumulative ACK
+        self._ack_due_since = None
+        await self.emit_frame(Frame(frame_type, self.session_id, seq, self.ack, payload, codec))
+
+    def on_frame(self, frame):
+        """
+        Processes a received frame and returns the list of frames now deliverable in order
+        (empty for pure ACKs, duplicates and frames waiting behind a gap).
+        """
+        self._on_ack(frame.ack)
+        if frame.frame_type == FRAME_ACK or frame.seq == 0:
+            return []
+
+        if self._ack_due_since is None:
+            self._ack_due_since = time.monotonic()
+        if frame.seq < self.next_recv_seq or frame.seq in self.reorder_buffer:
+            return [] # Duplicate (e.g. our ACK was lost); acknowledging again stops the resends
+
+        self.reorder_buffer[frame.seq] = frame
+        delivered = []
+        while self.next_recv_seq in self.reorder_buffer:
+            delivered.append(self.reorder_buffer.pop(self.next_recv_seq))
+            self.next_recv_seq += 1
+        return delivered
+
+    def _on_ack(self, ack):
+        if not self.unacked or ack < min(self.unacked):
+            return
+        now = time.monotonic()
+        for seq in [seq for seq in self.unacked if seq <= ack]:
+            entry = self.unacked.pop(seq)
+            if entry['retransmits'] == 0: # Karn's rule: only unambiguous samples
+                self._update_rto(now - entry['sent_at'])
+        if len(self.unacked) < self.window:
+            self._window_open.set()
+
+    def _update_rto(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+
+    async def tick(self):
+        """
+        Retransmits frames whose RTO expired and sends a standalone ACK if one has been
+        owed for longer than ack_delay without outgoing data to carry it.
+        """
+        now = time.monotonic()
+        for seq in sorted(self.unacked):
+            entry = self.unacked.get(seq)
+            # Exponential backoff, capped at MAX_RTO so a few lost bundles cannot stall the window for long
+            if entry is None or now - entry['sent_at'] < min(MAX_RTO, self.rto * (2 ** entry['retransmits'])):
+                continue
+            if entry['retransmits'] >= self.max_retransmits:
+                logging.error(f"Session {self.session_id}: Frame {seq} not acknowledged after "
+                              f"{self.max_retransmits} retransmissions, giving up")
+                self.failed = True
+                self.unacked.clear()
+                self._window_open.set()
+                return
+            entry['retransmits'] += 1
+            entry['sent_at'] = now
+            self.retransmissions += 1
+            sampler.log('retransmit', logging.WARNING, f"Session {self.session_id}: Retransmitting frame {seq} "
+                                                        f"(attempt {entry['retransmits']})")
+            await self._emit(entry['frame_type'], seq, entry['payload'], entry['codec'])
+
+        if self._ack_due_since is not None and now - self._ack_due_since >= self.ack_delay:
+            await self._emit(FRAME_ACK, 0, b'')
+
+
+async def service_channels(get_channels, interval=0.25):
+    """
+    Background loop driving the timers (retransmissions, delayed ACKs) of all channels.
+    get_channels() returns the ReliableChannel objects currently alive.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        for channel in list(get_channels()):
+            try:
+                await channel.tick()
+            except Exception as e:
+                sampler.log('timer_error', logging.ERROR, f"Session {channel.session_id}: Reliable transport timer error: {e}",
+                            exc_info=debug_tracebacks())
@@ -1,12 +1,27 @@
 import asyncio
+import functools
 import socket
 import time
-import struct
+import uuid
 import logging
+from collections import OrderedDict, deque
 import requests # Required for handling HTTP requests
 
 # Import necessary functions from drive_utils_requests module
-from drive_utils_requests import encrypt_data, decrypt_data, upload_file, download_file, list_files_in_folder, delete_file, get_token
+from drive_utils_requests import encrypt_data, decrypt_data, get_token
+from storage_backends import create_storage_backend
+from poll_scheduler import AdaptivePoller
+from packet_gc import PacketCollector
+from reliable_transport import ReliableChannel, service_channels
+from bundle_format import (
+    BUNDLE_VERSION, FRAME_DATA, FRAME_OPEN, FRAME_FIN, FRAME_CLOSE, BundleBatcher,
+    encode_bundle, decode_bundle, decode_bundle_header, decode_open_payload, BundleFormatError,
+)
+from compression import LOCAL_CODECS_MASK, DEFAULT_PEER_CODECS_MASK, compress_for_peer, decompress_payload
+import metrics
+from metrics import time_stage, observe_list_lag
+from tunnel_logging import setup_logging, trace, sampler, debug_tracebacks
+from upstream_pool import UpstreamPool
 
 # --- Server Configuration ---
 # IMPORTANT: Replace these IDs with the actual IDs of your Google Drive folders.
@@ -14,99 +29,530 @@ from drive_utils_requests import encrypt_data, decrypt_data, upload_file, downlo
 REQUESTS_FOLDER_ID = '1CtHCatylPW-Llfoj17vNaLETMPlyjfPt' # Folder where client uploads requests
 RESPONSES_FOLDER_ID = '1a4E5NitMH5rn0Feu02uZrfa4KvI1vR3O' # Folder where server uploads responses
 
-# Logging setup
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Response bundling: response frames of all sessions are packed into one bundle file
+# once BUNDLE_MAX_BYTES are buffered or BUNDLE_MAX_DELAY seconds have passed.
+BUNDLE_MAX_BYTES = 256 * 1024
+BUNDLE_MAX_DELAY = 0.05
+
+# Concurrency: request frames of up to MAX_CONCURRENT_SESSIONS sessions are applied in
+# parallel (each session's packets still strictly in order), and up to
+# MAX_CONCURRENT_DOWNLOADS request bundles are downloaded at once
+MAX_CONCURRENT_SESSIONS = 16
+MAX_CONCURRENT_DOWNLOADS = 8
+
+# Reliable transport (see reliable_transport.py): at most RELIABLE_WINDOW unacknowledged
+# response packets in flight per session; unacknowledged packets are retransmitted after
+# a timeout starting at RELIABLE_INITIAL_RTO seconds and adapted to the measured round trip
+RELIABLE_WINDOW = 64
+RELIABLE_INITIAL_RTO = 10.0
+
+COMPRESSION_ENABLED = True # Compress frame payloads before encryption (see compression.py)
+
+# Bytes read from a destination per response packet
+UPSTREAM_READ_SIZE = 64 * 1024
+
+# Upstream connections idle for longer than this (seconds) are closed by the server
+SESSION_IDLE_TIMEOUT = 300
+
+# Ids of this many sessions whose state was dropped are remembered, so late retransmissions
+# for them (even of their OPEN) are ignored instead of starting the session over
+FORGOTTEN_SESSIONS_MAX = 4096
+
+# After the client half-closed a session (FIN), its upstream connection is closed once the
+# destination has sent nothing for this many seconds: a browser that fully closed its
+# connection also just sends FIN, and not every destination closes on EOF
+HALF_CLOSED_IDLE_TIMEOUT = 30
+
+# Connections to destinations (see upstream_pool.py): DNS answers are cached for
+# UPSTREAM_DNS_TTL seconds, dual-stack hosts are connected happy-eyeballs style, and
+# UPSTREAM_WARM_CONNECTIONS fresh connections per recently used destination (at most
+# UPSTREAM_WARM_HOSTS of them) are opened ahead of time and kept for UPSTREAM_WARM_MAX_AGE
+# seconds, so the next session to the same destination skips the DNS lookup and handshake
+UPSTREAM_DNS_TTL = 60
+UPSTREAM_WARM_CONNECTIONS = 1
+UPSTREAM_WARM_HOSTS = 32
+UPSTREAM_WARM_MAX_AGE = 15
+UPSTREAM_CONNECT_TIMEOUT = 10
+
+# Discover new files through the Drive changes feed (list_new_files) instead of
+# listing the whole folder on every poll; API cost then tracks new traffic, not folder size
+USE_CHANGES_FEED = False
+
+# Maximum number of request files taken from one (multi-page) folder listing; when a
+# burst leaves more than this queued, the next batch is listed without sleeping
+# (not applied to the changes feed, which reports every new file exactly once)
+DRAIN_BATCH_SIZE = 500
+
+# Adaptive polling of the Drive folder (see poll_scheduler.py): every POLL_MIN_INTERVAL
+# seconds while data is moving (and for POLL_BURST_DURATION seconds after), backing off
+# by POLL_BACKOFF_FACTOR per empty poll up to POLL_MAX_INTERVAL seconds while idle.
+POLL_MIN_INTERVAL = 0.15
+POLL_MAX_INTERVAL = 5.0
+POLL_BACKOFF_FACTOR = 2.0
+POLL_BURST_DURATION = 2.0
+
+# Garbage collection of consumed packet files (see packet_gc.py): deletions are
+# batched every GC_FLUSH_INTERVAL seconds; files this side uploaded that are still
+# unconsumed after ORPHAN_MAX_AGE seconds are swept every GC_SWEEP_INTERVAL seconds
+GC_FLUSH_INTERVAL = 1.0
+GC_SWEEP_INTERVAL = 300
+ORPHAN_MAX_AGE = 900
+
+# Metrics (see metrics.py): served in the Prometheus text format at
+# http://METRICS_HOST:METRICS_PORT/metrics (None disables the endpoint), and written to
+# METRICS_DUMP_FILE every METRICS_DUMP_INTERVAL seconds if a file is set
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9109
+METRICS_DUMP_FILE = None
+METRICS_DUMP_INTERVAL = 60
+
+# Logging (see tunnel_logging.py): records are written by a background thread, to
+# LOG_FILE if set. LOG_LEVEL 'TRACE' also logs every packet and bundle (costly at high rates)
+LOG_LEVEL = 'INFO'
+LOG_FILE = None
+setup_logging(LOG_LEVEL, LOG_FILE)
+
+# Dictionary of tunnelled sessions with an open connection to their destination
+# key: session_id, value: {'reader': asyncio.StreamReader, 'writer': asyncio.StreamWriter,
+#                          'reader_task': asyncio.Task, 'last_activity': float,
+#                          'half_closed': bool, True once the client sent FIN}
+upstream_sessions = {}
+
+# Unique ID of this server process, used in response bundle file names and as the
+# context of the key its bundles are encrypted with (see encrypt_data)
+SERVER_ID = uuid.uuid4().hex
+bundle_counter = 0
+
+# Response batchers, one per client, so that every response bundle is addressed to a single
+# client and a client only ever downloads and deletes its own bundles (see response_batcher_for)
+# key: client ID, value: {'batcher': BundleBatcher, 'task': asyncio.Task running it}
+response_batchers = {}
+
+# Compression codecs each client can decompress, as advertised in the last bundle received from it
+# key: client ID, value: codecs mask (DEFAULT_PEER_CODECS_MASK for clients not heard from)
+peer_codecs_masks = {}
+
+# SessionScheduler applying request frames and the semaphore bounding concurrent
+# bundle downloads, created by handle_drive_requests()
+request_scheduler = None
+download_semaphore = None
+
+# Storage the packet files go through (see storage_backends.py): Google Drive, through the
+# asyncio Drive client when aiohttp is installed; replace it with another StorageBackend
+# (e.g. a LocalDirectoryStorageBackend) to run without Google Drive
+storage = create_storage_backend('drive', use_changes_feed=USE_CHANGES_FEED)
+
+# Background collector deleting consumed request bundles (and orphaned response bundles)
+packet_collector = PacketCollector(storage, flush_interval=GC_FLUSH_INTERVAL, sweep_folders=[RESPONSES_FOLDER_ID],
+                                   sweep_interval=GC_SWEEP_INTERVAL, orphan_max_age=ORPHAN_MAX_AGE)
+
+# DNS cache and warm connections for the destinations of new sessions
+upstream_pool = UpstreamPool(dns_ttl=UPSTREAM_DNS_TTL, warm_per_host=UPSTREAM_WARM_CONNECTIONS,
+                             warm_max_age=UPSTREAM_WARM_MAX_AGE, max_hosts=UPSTREAM_WARM_HOSTS,
+                             connect_timeout=UPSTREAM_CONNECT_TIMEOUT)
+
+# Poll scheduler of the requests folder
+request_poller = AdaptivePoller(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL, POLL_BACKOFF_FACTOR, POLL_BURST_DURATION)
+
+async def upload_response_bundle(client_id, frames):
+    """
+    Encrypts the response frames of a client's sessions gathered by its response
+    batcher as one bundle and uploads it to the _responses folder.
+    """
+    global bundle_counter
+    bundle_counter += 1
+    # File name format: ClientID_ServerID_BundleID.bundle.enc (zero-padded so names sort in upload order)
+    file_name = f"{client_id}_{SERVER_ID}_{bundle_counter:010d}.bundle.enc"
+    with time_stage('encrypt'):
+        encrypted_bundle = encrypt_data(encode_bundle(frames, LOCAL_CODECS_MASK), context=SERVER_ID.encode())
+    trace("Server: Uploading response bundle %d (%d frames, %d bytes)", bundle_counter, len(frames), len(encrypted_bundle))
+    with time_stage('upload'):
+        file_id = await storage.upload(file_name, encrypted_bundle, RESPONSES_FOLDER_ID)
+    if not file_id:
+        logging.error(f"Server: Failed to upload response bundle {bundle_counter}")
+
+def response_batcher_for(client_id):
+    """
+    Returns the batcher of the response bundles addressed to a client, starting it on first use.
+    """
+    entry = response_batchers.get(client_id)
+    if entry is None:
+        batcher = BundleBatcher(functools.partial(upload_response_bundle, client_id), BUNDLE_MAX_BYTES, BUNDLE_MAX_DELAY)
+        entry = response_batchers[client_id] = {'batcher': batcher, 'task': asyncio.create_task(batcher.run())}
+    return entry['batcher']
+
+def forget_idle_clients(active_clients):
+    """
+    Stops the batchers of clients that no longer have a session and nothing left to send,
+    and forgets the codecs of clients without sessions.
+    """
+    for client_id, entry in list(response_batchers.items()):
+        if client_id not in active_clients and entry['batcher'].idle:
+            entry['task'].cancel()
+            del response_batchers[client_id]
+    for client_id in list(peer_codecs_masks):
+        if client_id not in active_clients:
+            del peer_codecs_masks[client_id]
+
+async def open_upstream_session(session_id, dest_addr, dest_port):
+    """
+    Opens the connection to the internet destination for a session and starts
+    the task that streams everything the destination sends back to Google Drive.
+    The connection stays open for the lifetime of the session.
+    """
+    logging.info(f"Server: Connecting to {dest_addr}:{dest_port} for session {session_id}")
+    # Establish a direct TCP connection to the destination (cached DNS, warm socket if available)
+    with time_stage('upstream_connect'):
+        reader, writer = await upstream_pool.open_connection(dest_addr, dest_port)
+    session = {
+        'reader': reader,
+        'writer': writer,
+        'reader_task': None,
+        'last_activity': time.monotonic(),
+        'half_closed': False,
+    }
+    upstream_sessions[session_id] = session
+    metrics.active_sessions.inc(side='server')
+    session['reader_task'] = asyncio.create_task(relay_upstream_responses(session_id, session))
+    return session
+
+async def relay_upstream_responses(session_id, session):
+    """
+    Continuously reads from the destination of a session and sends every chunk
+    as an ordered response frame over the session's reliable channel, until the
+    destination closes the connection; the client is then sent a CLOSE frame.
+    """
+    channel = request_scheduler.channel_for(session_id)
+    try:
+        while True:
+            with time_stage('upstream_read'):
+                response_data = await session['reader'].read(UPSTREAM_READ_SIZE)
+            if not response_data:
+                logging.info(f"Server: Destination closed connection for session {session_id}")
+                break
+
+            session['last_activity'] = time.monotonic()
+            # The frame is uploaded together with other sessions' responses in the next response bundle
+            # (waits while the session's window of unacknowledged packets is full)
+            peer_mask = peer_codecs_masks.get(request_scheduler.client_of(session_id), DEFAULT_PEER_CODECS_MASK)
+            codec, payload = compress_for_peer(response_data, peer_mask, COMPRESSION_ENABLED)
+            packet_id = await channel.send(FRAME_DATA, payload, codec)
+            metrics.session_bytes_total.inc(len(response_data), session=session_id, direction='out')
+            trace("Server: Queued response packet %d for %s (%d bytes)", packet_id, session_id, len(response_data))
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Server: Error relaying responses for session {session_id}: {e}", exc_info=debug_tracebacks())
+    finally:
+        if upstream_sessions.get(session_id) is session: # Not already closed by the idle sweep
+            await close_upstream_session(session_id, cancel_reader=False)
+    # The destination closed the connection (or failed): CLOSE follows the last DATA frame
+    await channel.send(FRAME_CLOSE)
+
+async def close_upstream_session(session_id, cancel_reader=True):
+    """
+    Closes the destination connection of a session and removes it from the session table.
+    """
+    session = upstream_sessions.pop(session_id, None)
+    if session is None:
+        return
+    metrics.active_sessions.dec(side='server')
+    for direction in ('out', 'in'):
+        metrics.session_bytes_total.remove(session=session_id, direction=direction)
+    if cancel_reader and session['reader_task'] is not None:
+        session['reader_task'].cancel()
+    writer = session['writer']
+    if not writer.is_closing():
+        writer.close() # Close connection to destination
+    try:
+        await writer.wait_closed() # Wait for connection to close gracefully
+    except Exception:
+        pass
+    logging.info(f"Server: Session {session_id} closed")
+
+async def close_idle_sessions():
+    """
+    Closes upstream connections of sessions that have seen no traffic in either
+    direction for SESSION_IDLE_TIMEOUT seconds (e.g. the client went away), or for
+    HALF_CLOSED_IDLE_TIMEOUT seconds after the client sent FIN, and tells the client with
+    a CLOSE frame.
+    """
+    upstream_pool.prune() # Expired warm connections and DNS answers
+    now = time.monotonic()
+    for session_id, session in list(upstream_sessions.items()):
+        timeout = HALF_CLOSED_IDLE_TIMEOUT if session['half_closed'] else SESSION_IDLE_TIMEOUT
+        if now - session['last_activity'] > timeout:
+            logging.info(f"Server: Session {session_id} idle for {timeout}s, closing")
+            await close_upstream_session(session_id)
+            # The reader task was cancelled and sends nothing; don't wait for a window a gone client never opens
+            await request_scheduler.channel_for(session_id).send(FRAME_CLOSE, wait_for_window=False)
+    # Sessions without a connection and without recent packets no longer need ordering state
+    for session_id in request_scheduler.idle_sessions(SESSION_IDLE_TIMEOUT):
+        if session_id not in upstream_sessions:
+            request_scheduler.forget(session_id)
+    forget_idle_clients(request_scheduler.clients())
+
+class SessionScheduler:
+    """
+    Applies request frames of different sessions concurrently while keeping each
+    session's frames strictly in packet-id (seq) order.
+    State is only created for a session by its OPEN frame; other frames of unknown or
+    forgotten sessions are dropped (a lost OPEN is retransmitted by the client).
+
+    Every session has a ReliableChannel, which reorders incoming frames, drops
+    duplicates and acknowledges them (retransmissions fill any gap). Whenever the
+    channel delivers frames, a worker task for that session applies them in order.
+    At most max_concurrency session workers run at the same time, so one slow
+    destination only delays its own session.
+    """
+
+    def __init__(self, apply_frame, max_concurrency):
+        self.apply_frame = apply_frame # async def apply_frame(frame)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # key: session_id, value: {'channel': ReliableChannel, 'ready': deque of in-order Frames,
+        #                          'task': asyncio.Task, 'last_submit': float,
+        #                          'client_id': str, ID of the client that opened the session}
+        self._sessions = {}
+        self._forgotten = OrderedDict() # key: id of a forgotten session, value: None; oldest first
+
+    def channel_for(self, session_id):
+        """
+        Returns the reliable channel of a session.
+        """
+        return self._sessions[session_id]['channel']
+
+    def channels(self):
+        return [state['channel'] for state in self._sessions.values()]
+
+    def client_of(self, session_id):
+        """
+        Returns the ID of the client that opened a session (None if it is not known).
+        """
+        state = self._sessions.get(session_id)
+        return state['client_id'] if state is not None else None
+
+    def clients(self):
+        """
+        Returns the IDs of the clients that have sessions.
+        """
+        return {state['client_id'] for state in self._sessions.values()}
+
+    def submit(self, frame, client_id):
+        """
+        Passes a frame received from client_id to its session's channel and starts the
+        session's worker for any frames that became deliverable. The session's responses
+        go to the client that opened it.
+        """
+        state = self._sessions.get(frame.session_id)
+        if state is None:
+            if frame.frame_type != FRAME_OPEN or frame.session_id in self._forgotten:
+                trace("Server: Ignoring frame %d of unknown session %s", frame.seq, frame.session_id)
+                return
+            channel = ReliableChannel(frame.session_id, response_batcher_for(client_id).add,
+                                      RELIABLE_WINDOW, RELIABLE_INITIAL_RTO)
+            state = self._sessions[frame.session_id] = {'channel': channel, 'ready': deque(), 'task': None,
+                                                        'last_submit': time.monotonic(), 'client_id': client_id}
+        state['last_submit'] = time.monotonic()
+        state['ready'].extend(state['channel'].on_frame(frame))
+        if state['task'] is None and state['ready']:
+            state['task'] = asyncio.create_task(self._run_session(frame.session_id, state))
+
+    async def _run_session(self, session_id, state):
+        try:
+            async with self._semaphore:
+                while state['ready']:
+                    await self.apply_frame(state['ready'].popleft())
+        finally:
+            state['task'] = None
+
+    def forget(self, session_id):
+        """
+        Drops the state of a finished session.
+        """
+        state = self._sessions.pop(session_id, None)
+        if state is not None and state['task'] is not None:
+            state['task'].cancel()
+        self._forgotten[session_id] = None
+        while len(self._forgotten) > FORGOTTEN_SESSIONS_MAX:
+            self._forgotten.popitem(last=False)
+
+    def idle_sessions(self, max_idle):
+        """
+        Returns the ids of sessions with nothing queued, in flight or owed, and
+        no new frame for more than max_idle seconds (frames still waiting behind a
+        gap are abandoned then, see ReliableChannel.idle).
+        """
+        now = time.monotonic()
+        return [sid for sid, state in self._sessions.items()
+                if state['task'] is None and not state['ready'] and state['channel'].idle
+                and now - state['last_submit'] > max_idle]
+
+async def process_request_bundle(file_info, previous_submitted=None, submitted=None):
+    """
+    Downloads and decodes one request bundle and submits its frames to the session scheduler.
+    Bundles are downloaded concurrently, but a bundle's frames are only submitted after
+    previous_submitted (an asyncio.Event set by the preceding bundle) is set, so that a
+    session's OPEN is submitted before the frames that follow it in later bundles;
+    submitted is set once this bundle is done.
+    """
+    trace("Server: Processing request bundle %s", file_info['name'])
+    try:
+        async with download_semaphore:
+            # Download the request bundle
+            with time_stage('download'):
+                content_bytes = await storage.download(file_info['id'])
+        if content_bytes:
+            with time_stage('decrypt'):
+                decrypted_data = decrypt_data(content_bytes) # Decrypt the content
+            if decrypted_data:
+                try:
+                    version, _, peer_mask, _ = decode_bundle_header(decrypted_data)
+                    if version < BUNDLE_VERSION:
+                        # Older clients put the destination in front of every DATA payload instead of sending OPEN
+                        sampler.log('old_client', logging.ERROR,
+                                    f"Server: Ignoring request bundle {file_info['name']} of version {version}, "
+                                    f"the client needs to be updated")
+                        return
+                    frames = decode_bundle(decrypted_data)
+                    client_id = file_info['name'].split('_', 1)[0] # Request bundles are named ClientID_BundleID
+                    peer_codecs_masks[client_id] = peer_mask
+                    if previous_submitted is not None:
+                        await previous_submitted.wait()
+                    for frame in frames:
+                        request_scheduler.submit(frame, client_id)
+                except BundleFormatError as e:
+                    logging.error(f"Server: Malformed request bundle {file_info['name']}: {e}")
+            else:
+                logging.error(f"Server: Failed to decrypt request for {file_info['name']}. Deleting.")
+        else:
+            logging.error(f"Server: Failed to download request for {file_info['name']}. Deleting.")
+    finally:
+        if submitted is not None:
+            submitted.set()
+        # Always delete the request bundle from Drive after processing (success or failure);
+        # the collector batches the deletion in the background, off the data path
+        packet_collector.discard(file_info['id'])
+
+async def apply_request_frame(frame):
+    """
+    Applies one frame of a session, in order: OPEN connects to the destination it names,
+    DATA is written to the destination, FIN half-closes the destination connection
+    (the client sends no more data) and CLOSE closes it.
+    """
+    session_id = frame.session_id
+    try:
+        if frame.frame_type == FRAME_OPEN:
+            dest_addr, dest_port = decode_open_payload(frame.payload)
+            try:
+                await open_upstream_session(session_id, dest_addr, dest_port)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.warning(f"Server: Could not connect to {dest_addr}:{dest_port} for session {session_id}: {e}")
+                await request_scheduler.channel_for(session_id).send(FRAME_CLOSE) # The client closes its connection
+            return
+
+        session = upstream_sessions.get(session_id)
+        if frame.frame_type == FRAME_DATA:
+            data = decompress_payload(frame.codec, frame.payload)
+            trace("Server: Processing packet %d of session %s (%d bytes)", frame.seq, session_id, len(data))
+            if session is None: # Connection failed or already closed by the destination
+                sampler.log('closed_session', logging.WARNING,
+                            f"Server: Dropping {len(data)} bytes for closed session {session_id}")
+                return
+            session['writer'].write(data) # Send the data to the destination
+            metrics.session_bytes_total.inc(len(data), session=session_id, direction='in')
+            await session['writer'].drain() # Ensure data is sent
+            session['last_activity'] = time.monotonic()
+        elif frame.frame_type == FRAME_FIN:
+            if session is not None:
+                session['half_closed'] = True
+                session['last_activity'] = time.monotonic()
+                if session['writer'].can_write_eof():
+                    session['writer'].write_eof() # Responses keep flowing until the destination closes
+        elif frame.frame_type == FRAME_CLOSE:
+            logging.info(f"Server: Session {session_id} closed by the client")
+            await close_upstream_session(session_id)
+        else:
+            sampler.log('unknown_frame', logging.WARNING,
+                        f"Server: Ignoring frame of type {frame.frame_type} for session {session_id}")
+    except Exception as e:
+        sampler.log('apply_error', logging.ERROR,
+                    f"Server: Error in internal tunnel processing for session {session_id}: {e}",
+                    exc_info=debug_tracebacks())
 
 async def handle_drive_requests():
     """
-    Continuously monitors the _requests folder in Google Drive for new requests,
-    processes them by connecting to the internet destination, and uploads responses
-    to the _responses folder.
+    Continuously monitors the _requests folder in Google Drive for new request bundles and
+    forwards the frames they carry to the internet destination over each session's
+    persistent connection.
+    Responses are streamed back to the _responses folder by each session's reader task,
+    bundled across the sessions of each client by its response batcher.
     """
+    global request_scheduler, download_semaphore
+    request_scheduler = SessionScheduler(apply_request_frame, MAX_CONCURRENT_SESSIONS)
+    download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+    collector_task = asyncio.create_task(packet_collector.run())
+    # Retransmission and delayed-ACK timers of all sessions' reliable channels
+    timers_task = asyncio.create_task(service_channels(request_scheduler.channels))
+    metrics_server = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT) if METRICS_PORT else None
+    dump_task = (asyncio.create_task(metrics.dump_metrics_periodically(METRICS_DUMP_FILE, METRICS_DUMP_INTERVAL))
+                 if METRICS_DUMP_FILE else None)
+
     logging.info(f"Server: Listening for requests in '_requests' folder (ID: {REQUESTS_FOLDER_ID})...")
 
     while True:
         try:
-            # List files in the requests folder, running the blocking operation in a separate thread
-            files_in_request_folder = await asyncio.to_thread(list_files_in_folder, REQUESTS_FOLDER_ID)
+            # List files in the requests folder.
+            # A full listing is capped at DRAIN_BATCH_SIZE new files so a large backlog is drained in bulk
+            # batches; it also pages past the consumed files the collector has not deleted yet, which
+            # are still listed first (oldest) and would otherwise hide the rest of the backlog
+            if USE_CHANGES_FEED:
+                files_in_request_folder = await storage.list_new_files(REQUESTS_FOLDER_ID)
+                listing_full = False
+            else:
+                max_files = DRAIN_BATCH_SIZE + packet_collector.pending_count
+                files_in_request_folder = await storage.list_files(REQUESTS_FOLDER_ID, max_files=max_files)
+                listing_full = len(files_in_request_folder) >= max_files
             
             files_to_process = []
             for file_info in files_in_request_folder:
-                # Filter for encrypted request files
-                if file_info['name'].endswith('.request.enc'):
+                # Filter for encrypted request bundles not yet consumed (consumed bundles may
+                # still be listed until the collector has deleted them)
+                if file_info['name'].endswith('.bundle.enc') and not packet_collector.is_collected(file_info['id']):
                     files_to_process.append(file_info)
             
-            # Sort files by creation time to process them in order (oldest first)
-            files_to_process.sort(key=lambda x: x['createdTime']) 
-
+            # Sort files by creation time to process them in order (oldest first);
+            # bundles of one client also sort by their zero-padded bundle counter
+            files_to_process.sort(key=lambda x: (x['createdTime'], x['name'])) 
+            if not USE_CHANGES_FEED:
+                # Files beyond the cap are listed again next time; the changes feed would not
+                # report them again (its page token has moved past them), so it is never capped
+                files_to_process = files_to_process[:DRAIN_BATCH_SIZE]
             for file_info in files_to_process:
-                # Extract session_id and packet_id from the file name
-                session_id_part = file_info['name'].split('_')[0]
-                packet_id_part = file_info['name'].split('_')[1].split('.')[0]
-
-                logging.info(f"Server: Processing request {file_info['name']} (Session: {session_id_part}, Packet: {packet_id_part})")
-                
-                # Download the request file content
-                content_bytes = await asyncio.to_thread(download_file, file_info['id'])
-                if content_bytes:
-                    decrypted_data = decrypt_data(content_bytes) # Decrypt the content
-                    if decrypted_data:
-                        try:
-                            # --- Internal Tunnel Protocol (as defined in client.py) ---
-                            # First 1 byte: length of destination address (N)
-                            # Next 2 bytes: destination port (P)
-                            # Next N bytes: destination address (e.g., example.com)
-                            # Remaining bytes: actual data
-                            
-                            # Unpack the header to get destination address and port
-                            dest_addr_len = struct.unpack('!B', decrypted_data[0:1])[0]
-                            dest_port = struct.unpack('!H', decrypted_data[1:3])[0]
-                            dest_addr_bytes = decrypted_data[3 : 3 + dest_addr_len]
-                            dest_addr = dest_addr_bytes.decode('utf-8')
-                            actual_data = decrypted_data[3 + dest_addr_len:] # Extract the actual data payload
-
-                            logging.info(f"Server: Connecting to {dest_addr}:{dest_port}")
-                            
-                            # Establish a direct TCP connection to the destination
-                            reader, writer = await asyncio.open_connection(dest_addr, dest_port)
-                            
-                            writer.write(actual_data) # Send the data to the destination
-                            await writer.drain() # Ensure data is sent
-
-                            # Read the response from the internet destination
-                            response_data = await reader.read(4096) # Read up to 4KB of response
-                            writer.close() # Close connection to destination
-                            await writer.wait_closed() # Wait for connection to close gracefully
-
-                            if response_data:
-                                encrypted_response_data = encrypt_data(response_data) # Encrypt the response
-                                # File name format: SessionID_PacketID.response.enc
-                                response_file_name = f"{session_id_part}_{packet_id_part}.response.enc"
-                                logging.info(f"Server: Uploading response for {session_id_part} to '_responses' ({len(response_data)} bytes)")
-                                # Upload the encrypted response file to Google Drive
-                                await asyncio.to_thread(upload_file, response_file_name, encrypted_response_data, RESPONSES_FOLDER_ID)
-                            else:
-                                logging.warning(f"Server: No response data received from {dest_addr}:{dest_port}")
-
-                        except Exception as e:
-                            logging.error(f"Server: Error in internal tunnel processing for session {session_id_part}: {e}", exc_info=True)
-                        finally:
-                            # Always delete the request file from Drive after processing (success or failure)
-                            await asyncio.to_thread(delete_file, file_info['id'])
-                    else:
-                        logging.error(f"Server: Failed to decrypt request for {file_info['name']}. Deleting.")
-                        await asyncio.to_thread(delete_file, file_info['id']) # Delete corrupted or undecryptable file
-                else:
-                    logging.error(f"Server: Failed to download request for {file_info['name']}. Deleting.")
-                    await asyncio.to_thread(delete_file, file_info['id']) # Delete if download fails
-
-            await asyncio.sleep(1) # Check for new requests every 1 second (polling interval)
+                observe_list_lag(file_info['createdTime'])
+            # More may be queued behind a full listing, unless it held nothing new (then sleep as usual)
+            backlog_remaining = listing_full and bool(files_to_process)
+
+            # Bundles are downloaded concurrently; their frames are handed to the session scheduler
+            # in bundle order, and it applies them per session in packet-id order in the background
+            submitted = [asyncio.Event() for _ in files_to_process]
+            await asyncio.gather(*(process_request_bundle(file_info, submitted[index - 1] if index else None, submitted[index])
+                                   for index, file_info in enumerate(files_to_process)))
+
+            await close_idle_sessions()
+            # Poll fast while requests are flowing, back off while idle
+            request_poller.record_poll(bool(files_to_process))
+            metrics.poll_interval_seconds.set(request_poller.current_interval, folder='requests')
+            if not backlog_remaining: # With a backlog left, list the next batch right away
+                await request_poller.sleep()
 
         except requests.exceptions.RequestException as error: # Catch errors specific to the 'requests' library
-            logging.error(f'Server: An HTTP/Request error occurred while interacting with Google Drive: {error}', exc_info=True)
+            sampler.log('poll_error', logging.ERROR,
+                        f'Server: An HTTP/Request error occurred while interacting with Google Drive: {error}',
+                        exc_info=debug_tracebacks())
             await asyncio.sleep(5) # Wait before retrying on network/API errors
         except Exception as e: # Catch any other unexpected errors
-            logging.error(f"Server: An unexpected error occurred: {e}", exc_info=True)
+            sampler.log('loop_error', logging.ERROR, f"Server: An unexpected error occurred: {e}",
+                        exc_info=debug_tracebacks())
             await asyncio.sleep(5) # Wait before retrying on unexpected errors
 
 if __name__ == '__main__':
@@ -0,0 +1,372 @@
+import abc
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import time
+import uuid
+from collections import Counter
+
+import drive_utils_requests
+import drive_async
+
+# --- Storage Backends ---
+# The tunnel only needs a handful of operations from the shared storage that carries
+# its packet files: list a folder, upload, download and delete files (plus a batch
+# delete). StorageBackend defines that interface as coroutines; client.py and
+# server.py talk to a backend object instead of calling Google Drive directly.
+#
+#   DriveStorageBackend           - Google Drive (drive_utils_requests), the real thing
+#   AsyncDriveStorageBackend      - Google Drive through the asyncio client (drive_async.py)
+#   MemoryStorageBackend          - in-process dict; client and server in one process
+#   LocalDirectoryStorageBackend  - a directory shared by client and server processes
+#
+# The two local backends can simulate API latency and a call quota, so the full
+# client <-> server pipeline can be benchmarked and tuned on one machine.
+#
+# Files are described by dicts with 'id', 'name' and 'createdTime' (RFC 3339), as
+# returned by the Drive API. Folder IDs of the local backends are plain names.
+
+
+class StorageBackend(abc.ABC):
+    """
+    Interface of the storage the tunnel moves its packet files through.
+    Every backend counts its calls per operation in call_counts and the payload
+    bytes it moved in bytes_uploaded / bytes_downloaded.
+    """
+
+    def __init__(self):
+        self.call_counts = Counter()
+        self.bytes_uploaded = 0
+        self.bytes_downloaded = 0
+
+    @abc.abstractmethod
+    async def list_files(self, folder_id, max_files=None):
+        """
+        Returns the files in a folder, oldest first (at most max_files).
+        """
+
+    async def list_new_files(self, folder_id):
+        """
+        Returns the files created in a folder since the previous call. Backends without
+        incremental discovery return the whole folder; consumers skip files they consumed.
+        """
+        return await self.list_files(folder_id)
+
+    @abc.abstractmethod
+    async def upload(self, file_name, content_bytes, folder_id):
+        """
+        Stores a new file (names are unique, existing files are never overwritten).
+        Returns the new file ID, or None on failure.
+        """
+
+    @abc.abstractmethod
+    async def download(self, file_id):
+        """
+        Returns the content of a file as bytes, or None on failure.
+        """
+
+    @abc.abstractmethod
+    async def delete(self, file_id):
+        """
+        Deletes a file. Returns True if it was deleted or did not exist.
+        """
+
+    async def delete_batch(self, file_ids):
+        """
+        Deletes many files. Returns a dict mapping each file ID to the result of delete().
+        """
+        results = {}
+        for file_id in file_ids:
+            results[file_id] = await self.delete(file_id)
+        return results
+
+
+class DriveStorageBackend(StorageBackend):
+    """
+    Google Drive backend. Runs the blocking drive_utils_requests calls in worker threads.
+    With use_changes_feed, list_new_files uses the Drive changes feed.
+    """
+
+    def __init__(self, use_changes_feed=False):
+        super().__init__()
+        self.use_changes_feed = use_changes_feed
+
+    @property
+    def throttled_calls(self):
+        """
+        Calls that had to wait for the Drive rate limiter (see drive_utils_requests.RateLimiter).
+        """
+        return drive_utils_requests.rate_limiter.throttled_calls
+
+    async def list_files(self, folder_id, max_files=None):
+        self.call_counts['list'] += 1
+        return await asyncio.to_thread(drive_utils_requests.list_files_in_folder, folder_id, max_files=max_files)
+
+    async def list_new_files(self, folder_id):
+        if not self.use_changes_feed:
+            return await self.list_files(folder_id)
+        self.call_counts['changes'] += 1
+        return await asyncio.to_thread(drive_utils_requests.list_new_files, folder_id)
+
+    async def upload(self, file_name, content_bytes, folder_id):
+        self.call_counts['upload'] += 1
+        # Packet file names are unique, so the overwrite check is skipped
+        file_id = await asyncio.to_thread(drive_utils_requests.upload_file, file_name, content_bytes, folder_id, overwrite=False)
+        if file_id:
+            self.bytes_uploaded += len(content_bytes)
+        return file_id
+
+    async def download(self, file_id):
+        self.call_counts['download'] += 1
+        content = await asyncio.to_thread(drive_utils_requests.download_file, file_id)
+        if content:
+            self.bytes_downloaded += len(content)
+        return content
+
+    async def delete(self, file_id):
+        self.call_counts['delete'] += 1
+        return await asyncio.to_thread(drive_utils_requests.delete_file, file_id)
+
+    async def delete_batch(self, file_ids):
+        self.call_counts['delete_batch'] += 1
+        return await asyncio.to_thread(drive_utils_requests.delete_files_batch, file_ids)
+
+
+class AsyncDriveStorageBackend(DriveStorageBackend):
+    """
+    Google Drive backend running the Drive calls as coroutines (see drive_async.py)
+    instead of in worker threads. The changes feed still runs in a thread; both share
+    the process-wide rate limiter and retry policy of drive_utils_requests.
+    """
+
+    def __init__(self, use_changes_feed=False):
+        super().__init__(use_changes_feed)
+        self.client = drive_async.AsyncDriveClient()
+
+    async def list_files(self, folder_id, max_files=None):
+        self.call_counts['list'] += 1
+        return await self.client.list_files_in_folder(folder_id, max_files=max_files)
+
+    async def upload(self, file_name, content_bytes, folder_id):
+        self.call_counts['upload'] += 1
+        # Packet file names are unique, so the overwrite check is skipped
+        file_id = await self.client.upload_file(file_name, content_bytes, folder_id, overwrite=False)
+        if file_id:
+            self.bytes_uploaded += len(content_bytes)
+        return file_id
+
+    async def download(self, file_id):
+        self.call_counts['download'] += 1
+        content = await self.client.download_file(file_id)
+        if content:
+            self.bytes_downloaded += len(content)
+        return content
+
+    async def delete(self, file_id):
+        self.call_counts['delete'] += 1
+        return await self.client.delete_file(file_id)
+
+    async def delete_batch(self, file_ids):
+        self.call_counts['delete_batch'] += 1
+        return await self.client.delete_files_batch(file_ids)
+
+
+class SimulatedStorageBackend(StorageBackend):
+    """
+    Base class of the local backends: adds a configurable per-call latency
+    (latency seconds plus up to jitter seconds, random) and a call quota of
+    calls_per_second (token bucket with a burst of `burst` calls; calls over the
+    quota wait for a token, and the wait is counted in throttled_calls).
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, calls_per_second=None, burst=10):
+        super().__init__()
+        self.latency = latency
+        self.jitter = jitter
+        self.calls_per_second = calls_per_second
+        self.burst = burst
+        self.throttled_calls = 0
+        self._tokens = float(burst)
+        self._tokens_updated = time.monotonic()
+        self._quota_lock = None # asyncio.Lock, created lazily inside the running loop
+
+    async def _api_call(self, operation):
+        """
+        Accounts for one API call: waits for quota, then for the simulated latency.
+        """
+        self.call_counts[operation] += 1
+        if self.calls_per_second:
+            if self._quota_lock is None:
+                self._quota_lock = asyncio.Lock()
+            async with self._quota_lock: # Waiters get tokens in arrival order
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._tokens_updated) * self.calls_per_second)
+                self._tokens_updated = now
+                if self._tokens < 1:
+                    self.throttled_calls += 1
+                    await asyncio.sleep((1 - self._tokens) / self.calls_per_second)
+                    self._tokens = 1.0
+                    self._tokens_updated = time.monotonic()
+                self._tokens -= 1
+        delay = self.latency + (random.random() * self.jitter if self.jitter else 0.0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _timestamp(ns=None):
+        """
+        RFC 3339 timestamp (as used by Drive's createdTime) with microsecond precision.
+        """
+        seconds = (time.time_ns() if ns is None else ns) / 1e9
+        moment = datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+        return moment.isoformat(timespec='microseconds').replace('+00:00', 'Z')
+
+
+class MemoryStorageBackend(SimulatedStorageBackend):
+    """
+    In-process backend keeping all files in a dict. Client and server must share the
+    same instance (i.e. run in one process), which makes it ideal for benchmarks.
+    """
+
+    def __init__(self, **limits):
+        super().__init__(**limits)
+        self._files = {} # key: file id, value: {'id', 'name', 'createdTime', 'folder', 'content'}
+        self._ids = itertools.count(1)
+
+    async def list_files(self, folder_id, max_files=None):
+        await self._api_call('list')
+        files = [{'id': f['id'], 'name': f['name'], 'createdTime': f['createdTime']}
+                 for f in self._files.values() if f['folder'] == folder_id]
+        files.sort(key=lambda x: x['createdTime'])
+        return files if max_files is None else files[:max_files]
+
+    async def upload(self, file_name, content_bytes, folder_id):
+        await self._api_call('upload')
+        file_id = f"mem{next(self._ids)}"
+        self._files[file_id] = {'id': file_id, 'name': file_name, 'createdTime': self._timestamp(),
+                                'folder': folder_id, 'content': bytes(content_bytes)}
+        self.bytes_uploaded += len(content_bytes)
+        return file_id
+
+    async def download(self, file_id):
+        await self._api_call('download')
+        entry = self._files.get(file_id)
+        if entry is None:
+            return None
+        self.bytes_downloaded += len(entry['content'])
+        return entry['content']
+
+    async def delete(self, file_id):
+        await self._api_call('delete')
+        self._files.pop(file_id, None)
+        return True
+
+    async def delete_batch(self, file_ids):
+        await self._api_call('delete_batch')
+        for file_id in file_ids:
+            self._files.pop(file_id, None)
+        return {file_id: True for file_id in file_ids}
+
+
+class LocalDirectoryStorageBackend(SimulatedStorageBackend):
+    """
+    Backend storing each folder as a subdirectory of root_dir, so a client and a
+    server running as separate processes on one machine can share it. Files are
+    written to a temporary name and renamed, so readers never see partial files.
+    File IDs are the 'folder/name' paths relative to root_dir.
+    """
+
+    def __init__(self, root_dir, **limits):
+        super().__init__(**limits)
+        self.root_dir = root_dir
+
+    def _path(self, file_id):
+        folder_id, file_name = file_id.split('/', 1)
+        return os.path.join(self.root_dir, folder_id, file_name)
+
+    def _list_sync(self, folder_id):
+        folder_path = os.path.join(self.root_dir, folder_id)
+        files = []
+        try:
+            entries = list(os.scandir(folder_path))
+        except FileNotFoundError:
+            return files
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue # In-progress uploads
+            try:
+                created_ns = entry.stat().st_mtime_ns
+            except FileNotFoundError:
+                continue # Deleted meanwhile
+            files.append({'id': f"{folder_id}/{entry.name}", 'name': entry.name, 'createdTime': self._timestamp(created_ns)})
+        files.sort(key=lambda x: (x['createdTime'], x['name']))
+        return files
+
+    async def list_files(self, folder_id, max_files=None):
+        await self._api_call('list')
+        files = await asyncio.to_thread(self._list_sync, folder_id)
+        return files if max_files is None else files[:max_files]
+
+    def _upload_sync(self, file_name, content_bytes, folder_id):
+        folder_path = os.path.join(self.root_dir, folder_id)
+        os.makedirs(folder_path, exist_ok=True)
+        tmp_path = os.path.join(folder_path, f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as file_obj:
+            file_obj.write(content_bytes)
+        os.replace(tmp_path, os.path.join(folder_path, file_name))
+        return f"{folder_id}/{file_name}"
+
+    async def upload(self, file_name, content_bytes, folder_id):
+        await self._api_call('upload')
+        file_id = await asyncio.to_thread(self._upload_sync, file_name, content_bytes, folder_id)
+        self.bytes_uploaded += len(content_bytes)
+        return file_id
+
+    def _download_sync(self, file_id):
+        try:
+            with open(self._path(file_id), 'rb') as file_obj:
+                return file_obj.read()
+        except FileNotFoundError:
+            return None
+
+    async def download(self, file_id):
+        await self._api_call('download')
+        content = await asyncio.to_thread(self._download_sync, file_id)
+        if content:
+            self.bytes_downloaded += len(content)
+        return content
+
+    def _delete_sync(self, file_id):
+        try:
+            os.remove(self._path(file_id))
+        except FileNotFoundError:
+            pass # Already gone counts as deleted
+        return True
+
+    async def delete(self, file_id):
+        await self._api_call('delete')
+        return await asyncio.to_thread(self._delete_sync, file_id)
+
+    async def delete_batch(self, file_ids):
+        await self._api_call('delete_batch')
+        return {file_id: await asyncio.to_thread(self._delete_sync, file_id) for file_id in file_ids}
+
+
+def create_storage_backend(kind='drive', **options):
+    """
+    Creates a backend by name: 'drive' (the asyncio client if aiohttp is installed,
+    threads otherwise), 'drive-sync', 'drive-async', 'memory' or 'local'
+    (options are passed to the class).
+    """
+    backends = {
+        'drive': AsyncDriveStorageBackend if drive_async.aiohttp else DriveStorageBackend,
+        'drive-sync': DriveStorageBackend,
+        'drive-async': AsyncDriveStorageBackend,
+        'memory': MemoryStorageBackend,
+        'local': LocalDirectoryStorageBackend,
+    }
+    if kind not in backends:
+        raise ValueError(f"Unknown storage backend: {kind}")
+    return backends[kind](**options)
@@ -0,0 +1,65 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Offline check of DriveTransport against a local HTTP server (no Google account needed):
+# retried responses must give their pooled connection back. Run: python test_drive_transport.py
+os.environ.setdefault('DRIVEVPN_ENCRYPTION_KEY', 'dGVzdC1rZXktbm90LWZvci1yZWFsLXVzZS0wMDAwMDA=')
+
+import drive_utils_requests
+from drive_utils_requests import DriveTransport
+
+DOWNLOADS = 10
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """
+    Answers every other request with 503, the others with a 64 KB body.
+    """
+    requests_seen = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with FlakyHandler.lock:
+            FlakyHandler.requests_seen += 1
+            fail = FlakyHandler.requests_seen % 2 == 1
+        body = b'busy' if fail else b'x' * 65536
+        self.send_response(503 if fail else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_retried_stream_releases_connection():
+    saved = drive_utils_requests.get_token, drive_utils_requests.DRIVE_BACKOFF_BASE
+    drive_utils_requests.get_token = lambda: 'test-token' # No token.json needed
+    drive_utils_requests.DRIVE_BACKOFF_BASE = 0.01
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}/file"
+    transport = DriveTransport(pool_size=1) # A single leaked connection would block the next request
+    completed = []
+
+    def download_all():
+        for _ in range(DOWNLOADS):
+            with transport.get(url, stream=True) as response:
+                assert response.status_code == 200
+                completed.append(len(b''.join(response.iter_content(8192))))
+
+    try:
+        worker = threading.Thread(target=download_all, daemon=True)
+        worker.start()
+        worker.join(timeout=30)
+    finally:
+        httpd.shutdown()
+        drive_utils_requests.get_token, drive_utils_requests.DRIVE_BACKOFF_BASE = saved
+    assert not worker.is_alive(), f"Downloads hung after {len(completed)} of {DOWNLOADS} (connection leaked)"
+    assert completed == [65536] * DOWNLOADS
+
+
+if __name__ == '__main__':
+    test_retried_stream_releases_connection()
+    print("DriveTransport: retried streamed downloads release their connections - OK")
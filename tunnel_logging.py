@@ -0,0 +1,92 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import time
+
+# --- Tunnel Logging ---
+# Logging setup shared by client.py and server.py, built to stay cheap at high packet rates:
+# - TRACE, a level below DEBUG for per-packet events. It is off by default and trace()
+#   checks the level before anything is formatted, so disabled trace calls cost only
+#   that check (pass values as %-style arguments, not pre-formatted f-strings).
+# - LogSampler, which lets through at most one record per key and interval for events
+#   that can repeat many times a second (retransmissions, polling errors), reporting
+#   how many were suppressed.
+# - A QueueHandler on the root logger: records are put on a queue and written by a
+#   QueueListener thread, so slow console or disk I/O never blocks the event loop.
+
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_SAMPLE_INTERVAL = 10.0 # Seconds between two records of the same sampled event
+
+_listener = None # QueueListener writing the records, started by setup_logging()
+
+
+def setup_logging(level=logging.INFO, log_file=None):
+    """
+    Routes the root logger through a queue to a background thread writing to stderr
+    (or to log_file). level may be a number or a name, including 'TRACE'.
+    Calling it again (e.g. client and server imported together) only updates the level.
+    """
+    global _listener
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None:
+        return
+    output = logging.FileHandler(log_file) if log_file else logging.StreamHandler()
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop) # Flushes the records still queued
+
+
+def trace(msg, *args):
+    """
+    Logs a per-packet event at TRACE level; nothing is formatted unless TRACE is enabled.
+    """
+    root = logging.getLogger()
+    if root.isEnabledFor(TRACE):
+        root.log(TRACE, msg, *args)
+
+
+def debug_tracebacks():
+    """
+    exc_info value for errors caught in long-running loops: full tracebacks only when
+    DEBUG logging is enabled, otherwise just the error message.
+    """
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+class LogSampler:
+    """
+    Logs at most one record per key every interval seconds; records dropped in between
+    are counted and reported with the next one that gets through.
+    """
+
+    def __init__(self, interval=LOG_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._last = {} # key: event key, value: [time of the last record logged, records suppressed since]
+
+    def log(self, key, level, msg, *args, **kwargs):
+        root = logging.getLogger()
+        if not root.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        state = self._last.get(key)
+        if state is not None and now - state[0] < self.interval:
+            state[1] += 1
+            return
+        suppressed = state[1] if state is not None else 0
+        self._last[key] = [now, 0]
+        if suppressed:
+            msg = f"{msg} (+{suppressed} similar in the last {self.interval:g}s)"
+        root.log(level, msg, *args, **kwargs)
+
+
+sampler = LogSampler()
@@ -0,0 +1,216 @@
+import asyncio
+import logging
+import socket
+import time
+from collections import OrderedDict, deque
+
+from metrics import upstream_connections_total
+
+
+def _interleave_families(infos):
+    """
+    Orders addresses as RFC 8305 suggests: alternating address families, starting
+    with the family of the first (preferred) address.
+    """
+    by_family = OrderedDict()
+    for info in infos:
+        by_family.setdefault(info[0], deque()).append(info)
+    ordered = []
+    while by_family:
+        for family in list(by_family):
+            ordered.append(by_family[family].popleft())
+            if not by_family[family]:
+                del by_family[family]
+    return ordered
+
+
+def _is_alive(sock):
+    """
+    True if an idle connected socket has not been closed by the peer.
+    """
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b'' # Data already sent by the peer (e.g. a banner) is fine
+    except BlockingIOError:
+        return True # Nothing to read: still open
+    except OSError:
+        return False
+
+
+class UpstreamPool:
+    """
+    Opens the server's connections to destinations, with less latency than a plain
+    asyncio.open_connection:
+
+    - DNS answers are cached per (host, port) for dns_ttl seconds, and concurrent
+      lookups of the same name share one getaddrinfo call. getaddrinfo does not report
+      record TTLs, so dns_ttl is the upper bound an answer is trusted for.
+    - Dual-stack destinations are connected happy-eyeballs style: address families
+      alternate and a new attempt starts every happy_eyeballs_delay seconds (or as
+      soon as one fails) until the first connection succeeds.
+    - For the max_hosts destinations used most recently, warm_per_host connections are
+      opened ahead of time, so the next session to the same destination starts on a
+      connected socket. A warm socket is never used before it is handed out: a TCP
+      stream that carried another session's data cannot safely be reused. Warm sockets
+      are dropped after warm_max_age seconds (servers close idle connections) or when
+      found closed.
+    """
+
+    def __init__(self, dns_ttl=60.0, warm_per_host=1, warm_max_age=15.0, max_hosts=32,
+                 happy_eyeballs_delay=0.25, connect_timeout=10.0):
+        self.dns_ttl = dns_ttl
+        self.warm_per_host = warm_per_host # 0 disables warm connections
+        self.warm_max_age = warm_max_age
+        self.max_hosts = max_hosts
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.connect_timeout = connect_timeout
+        self._dns = {} # key: (host, port), value: (expires_at, addrinfo list)
+        self._resolving = {} # key: (host, port), value: asyncio.Task of the lookup in progress
+        self._warm = OrderedDict() # key: (host, port), value: deque of (socket, connected_at); least recently used first
+        self._refilling = {} # key: (host, port), value: asyncio.Task topping up its warm sockets
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    async def resolve(self, host, port):
+        """
+        Returns the getaddrinfo results for a TCP connection to host:port, from the cache if fresh.
+        """
+        key = (host, port)
+        cached = self._dns.get(key)
+        if cached is not None and cached[0] > time.monotonic():
+            self.dns_hits += 1
+            return cached[1]
+        self.dns_misses += 1
+        task = self._resolving.get(key)
+        if task is None:
+            loop = asyncio.get_running_loop()
+            task = self._resolving[key] = asyncio.ensure_future(loop.getaddrinfo(host, port, type=socket.SOCK_STREAM))
+            task.add_done_callback(lambda _: self._resolving.pop(key, None))
+        infos = await asyncio.shield(task)
+        self._dns[key] = (time.monotonic() + self.dns_ttl, infos) # Failed lookups raise and are not cached
+        return infos
+
+    async def _connect_sock(self, host, port):
+        infos = _interleave_families(await self.resolve(host, port))
+        loop = asyncio.get_running_loop()
+
+        async def attempt(info):
+            family, type_, proto, _, address = info
+            sock = socket.socket(family, type_, proto)
+            try:
+                sock.setblocking(False)
+                await loop.sock_connect(sock, address)
+            except BaseException:
+                sock.close()
+                raise
+            return sock
+
+        pending, errors, winner = set(), [], None
+        remaining = deque(infos)
+        try:
+            while remaining or pending:
+                if remaining:
+                    pending.add(asyncio.create_task(attempt(remaining.popleft())))
+                done, pending = await asyncio.wait(pending, timeout=self.happy_eyeballs_delay if remaining else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        errors.append(task.exception())
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result().close()
+                if winner is not None:
+                    return winner
+        finally:
+            for task in pending:
+                task.cancel()
+            for result in await asyncio.gather(*pending, return_exceptions=True):
+                if isinstance(result, socket.socket):
+                    result.close() # Connected just before it was cancelled
+        if len(errors) == 1:
+            raise errors[0]
+        raise OSError(f"Could not connect to {host}:{port}: {'; '.join(str(e) for e in errors) or 'no addresses'}")
+
+    async def connect(self, host, port):
+        """
+        Returns a connected, never-used socket to host:port, warm if one is available.
+        """
+        key = (host, port)
+        sock = self._take_warm(key)
+        if sock is not None:
+            upstream_connections_total.inc(source='warm')
+        else:
+            sock = await asyncio.wait_for(self._connect_sock(host, port), self.connect_timeout)
+            upstream_connections_total.inc(source='new')
+        self._schedule_refill(key)
+        return sock
+
+    async def open_connection(self, host, port):
+        """
+        asyncio.open_connection replacement: returns (reader, writer) for host:port.
+        """
+        return await asyncio.open_connection(sock=await self.connect(host, port))
+
+    def _take_warm(self, key):
+        idle = self._warm.get(key)
+        if idle is None:
+            return None
+        self._warm.move_to_end(key)
+        now = time.monotonic()
+        while idle:
+            sock, connected_at = idle.popleft()
+            if now - connected_at <= self.warm_max_age and _is_alive(sock):
+                return sock
+            sock.close()
+        return None
+
+    def _schedule_refill(self, key):
+        if self.warm_per_host <= 0 or key in self._refilling:
+            return
+        self._warm.setdefault(key, deque())
+        self._warm.move_to_end(key)
+        while len(self._warm) > self.max_hosts:
+            _, idle = self._warm.popitem(last=False)
+            for sock, _ in idle:
+                sock.close()
+        task = self._refilling[key] = asyncio.create_task(self._refill(key))
+        task.add_done_callback(lambda _: self._refilling.pop(key, None))
+
+    async def _refill(self, key):
+        try:
+            while key in self._warm and len(self._warm[key]) < self.warm_per_host:
+                sock = await asyncio.wait_for(self._connect_sock(*key), self.connect_timeout)
+                idle = self._warm.get(key)
+                if idle is None: # Evicted meanwhile
+                    sock.close()
+                    return
+                idle.append((sock, time.monotonic()))
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.debug(f"Upstream pool: Could not pre-connect to {key[0]}:{key[1]}: {e}")
+
+    def prune(self):
+        """
+        Closes expired warm sockets and forgets expired DNS answers; call it periodically.
+        """
+        now = time.monotonic()
+        for key, idle in list(self._warm.items()):
+            for entry in list(idle):
+                if now - entry[1] > self.warm_max_age:
+                    idle.remove(entry)
+                    entry[0].close()
+            if not idle and key not in self._refilling:
+                del self._warm[key] # Not used for a while: stop keeping it warm
+        for key, (expires_at, _) in list(self._dns.items()):
+            if expires_at <= now:
+                del self._dns[key]
+
+    def close(self):
+        """
+        Closes all warm sockets and stops pre-connecting.
+        """
+        for task in list(self._refilling.values()):
+            task.cancel()
+        for idle in self._warm.values():
+            for sock, _ in idle:
+                sock.close()
+        self._warm.clear()